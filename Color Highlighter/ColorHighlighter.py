@@ -9,6 +9,10 @@ import subprocess
 import threading
 import shutil
 import codecs
+import bisect
+import struct
+import zlib
+from collections import deque
 
 try:
     import colors
@@ -335,15 +339,19 @@ for k in color_fmts_data.keys():
     if k not in regex_order and "r_str" in color_fmts_data[k].keys():
         regex_order.append(k)
 
+# group name in the "all" regex -> format, a match's lastgroup tells which format matched
+fmt_groups = {}
 def get_all_colors_rstrs():
     res = ""
     for k in regex_order:
         if "r_str" in color_fmts_data[k].keys():
-            res += "(?:%s)|" % color_fmts_data[k]["r_str"]
+            g = "f%d" % len(fmt_groups)
+            fmt_groups[g] = k
+            res += "(?P<%s>%s)|" % (g, color_fmts_data[k]["r_str"])
     return res[:-1]
 
 color_fmts_data["all"] = {
-    "r_str": "(%s)" % get_all_colors_rstrs(),
+    "r_str": get_all_colors_rstrs(),
     "m_str": "",
     "to_hex": None
 }
@@ -363,6 +371,93 @@ def find_all(regex, text):
         m = regex.search(text, m.end())
     return res
 
+def find_all_fmts(text):
+    res = []
+    regex = color_fmts_data["all"]["regex"]
+    m = regex.search(text)
+    while m:
+        res.append((m.start(), m.end(), fmt_groups[m.lastgroup]))
+        m = regex.search(text, m.end())
+    return res
+
+def memoized(size):
+    """Caches results of a function of hashable arguments, the cache is dropped when it's full."""
+    def decorator(f):
+        cache = {}
+        def wrapper(*args):
+            res = cache.get(args, cache)
+            if res is cache:
+                if len(cache) >= size:
+                    cache.clear()
+                res = f(*args)
+                cache[args] = res
+            return res
+        return wrapper
+    return decorator
+
+# multi-pattern matcher for color names and stylesheet variables
+
+class NamesMatcher:
+    """Aho-Corasick automaton, finds all the names in one pass over the text."""
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+        goto = [{}]
+        out = [()]
+        for name in self.names:
+            if len(name) == 0:
+                continue
+            node = 0
+            for c in name:
+                nxt = goto[node].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][c] = nxt
+                    goto.append({})
+                    out.append(())
+                node = nxt
+            out[node] = (len(name),)
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, nxt in goto[node].items():
+                queue.append(nxt)
+                f = fail[node]
+                while f != 0 and c not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(c, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+
+    def find_all(self, text, bound=low_letters):
+        """Returns (start, end) of every name occurence not glued to a letter from bound."""
+        res = []
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        tlen = len(text)
+        node = 0
+        i = 0
+        for c in text:
+            i += 1
+            while node != 0 and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if len(out[node]) == 0:
+                continue
+            if i != tlen and text[i] in bound:
+                continue
+            for l in out[node]:
+                s = i - l
+                if s == 0 or text[s - 1] not in bound:
+                    res.append((s, i))
+        return res
+
 # colors helpers
 
 def tohex(r, g, b, a=None):
@@ -379,15 +474,16 @@ def get_cont_col(col):
     return tohex(int(r * 255), int(g * 255), int(b * 255)) # true complementary
 
 
+@memoized(4096)
 def get_format(col):
     if col is None or len(col) == 0:
         return None
     if colors.names_to_hex.get(col):
         return "named"
-    for k in regex_order:
-        if color_fmts_data[k]["regex"].search(col):
-            return k
-    return None
+    m = color_fmts_data["all"]["regex"].search(col)
+    if m is None:
+        return None
+    return fmt_groups[m.lastgroup]
 
 def conv_to_format(base, col):
     base = base.strip()
@@ -402,6 +498,7 @@ def conv_to_format(base, col):
         return compress_hex4(col)
     return color_fmts_data[fmt]["from_hex"](base, col)
 
+@memoized(1024)
 def convert_format(base, col):
     return conv_to_format(base, color_fmts_data[get_format(col)]["to_hex"](col))
 
@@ -417,6 +514,10 @@ def name_to_hex(col, col_vars):
     if res is not None:
         return name_to_hex(res["col"], col_vars)
 
+    return literal_to_hex(col)
+
+@memoized(4096)
+def literal_to_hex(col):
     fmt = get_format(col)
     if fmt is None:
         return None
@@ -435,7 +536,8 @@ def get_word(view, reg):
     return sublime.Region(beg, end)
 
 
-bound_symbols = ["\n", "\t", " ", ";", ":", ",", "\'", "\"", ">", "<", "(", ")"]
+max_line_size = 1000 # longer lines (minified files) are not searched for colors
+bound_symbols = frozenset(["\n", "\t", " ", ";", ":", ",", "\'", "\"", ">", "<", "(", ")"])
 def isInColor(view, sel, col_vars, array_format, line=None):
     b = sel.begin()
     if b != sel.end():
@@ -470,24 +572,18 @@ def isInColor(view, sel, col_vars, array_format, line=None):
 
     if line is None:
         line = view.line(b)
-    if line.size() > 1000:
+    if line.size() > max_line_size:
         return None, None, None
     beg = line.begin()
-    matches = find_all(color_fmts_data["all"]["regex"], view.substr(line))
-    for s, e in matches:
-        s += beg
-        e += beg
-        if b < s or b > e:
+    text = view.substr(line)
+    for s, e, k in find_all_fmts(text):
+        if b < s + beg or b > e + beg:
             continue
-        for k in regex_order:
-            if not array_format and k.endswith("array"):
-                continue
-            word = sublime.Region(s, e)
-            col = view.substr(word)
-            if k[0] == "#" and (view.substr(word.begin() - 1) not in bound_symbols or view.substr(word.end()) not in bound_symbols):
-                continue
-            if color_fmts_data[k]["regex"].search(col):
-                return word, color_fmts_data[k]["to_hex"](col), False
+        if not array_format and k.endswith("array"):
+            continue
+        if k[0] == "#" and ((s != 0 and text[s - 1] not in bound_symbols) or (e != len(text) and text[e] not in bound_symbols)):
+            continue
+        return sublime.Region(s + beg, e + beg), literal_to_hex(text[s:e]), False
 
     return None, None, None
 
@@ -516,7 +612,11 @@ class HtmlGen:
     color_scheme = None
     fake_scheme = None
     need_upd = False
-    string = ""
+    strings = None
+    base = None
+    upd_gen = 0
+    upd_views = None
+    upd_delay = 50 # ms, bursts of new colors within this interval produce one scheme write
     gen_string = """
 <dict>
 <key>name</key>
@@ -539,21 +639,26 @@ class HtmlGen:
         self.color_scheme = cs
         self.fake_scheme = themes_path + cs.split('/')[-1]
         self.colors = []
+        self.colors_set = set()
+        self.strings = []
+        self.upd_views = {}
+
+    def _add(self, col):
+        self.colors.append(col)
+        self.colors_set.add(col)
+        cont = get_cont_col(col)
+        self.strings.append(self.gen_string % (region_name(col), col, cont, cont))
 
     def load(self, htmlGen):
-        new_cols = [x for x in htmlGen.colors if x not in self.colors]
+        new_cols = [x for x in htmlGen.colors if x not in self.colors_set]
         for col in new_cols:
-            cont = get_cont_col(col)
-            self.string += self.gen_string % (region_name(col), col, cont, cont)
-        self.colors += new_cols
-        self.need_upd = len(new_cols) != 0
+            self._add(col)
+        self.need_upd = self.need_upd or len(new_cols) != 0
 
     def add_color(self, col):
-        if col in self.colors:
+        if col in self.colors_set:
             return
-        self.colors.append(col)
-        cont = get_cont_col(col)
-        self.string += self.gen_string % (region_name(col), col, cont, cont)
+        self._add(col)
         self.need_upd = True
 
     def update_view(self, view):
@@ -562,24 +667,47 @@ class HtmlGen:
         else:
             return set_scheme(view, self.fake_scheme)
 
-    def update(self):
+    def get_base(self):
+        if self.base is None:
+            if get_version() >= 3000:
+                cont = sublime.load_resource(self.color_scheme)
+            else:
+                cont = read_file(to_abs_cs_path(self.color_scheme)).decode("utf-8")
+            n = cont.find("<array>") + len("<array>")
+            self.base = (cont[:n], cont[n:])
+        return self.base
+
+    def update(self, view=None):
+        """Schedules a scheme rewrite if there are new colors, view is switched to the new scheme after it."""
         if not self.need_upd:
             return False
 
-        if get_version() >= 3000:
-            cont = sublime.load_resource(self.color_scheme)
-        else:
-            cont = read_file(to_abs_cs_path(self.color_scheme)).decode("utf-8")
-        n = cont.find("<array>") + len("<array>")
-        cont = cont[:n] + self.string + cont[n:]
-        write_bin_file(to_abs_cs_path(self.fake_scheme), cont.encode("utf-8"))
+        if view is not None:
+            self.upd_views[view.id()] = view
+        self.upd_gen += 1
+        sublime.set_timeout(lambda g=self.upd_gen: self.do_update(g), self.upd_delay)
+        return True
 
+    def do_update(self, gen):
+        if gen != self.upd_gen or not self.need_upd:
+            return
         self.need_upd = False
-        return True
+
+        (head, tail) = self.get_base()
+        write_bin_file(to_abs_cs_path(self.fake_scheme), (head + "".join(self.strings) + tail).encode("utf-8"))
+
+        views = self.upd_views
+        self.upd_views = {}
+        for view in views.values():
+            self.update_view(view)
 
     def restore(self):
         self.colors = []
-        self.string = ""
+        self.colors_set = set()
+        self.strings = []
+        self.need_upd = False
+        self.upd_gen += 1
+        self.upd_views = {}
         path = to_abs_cs_path(self.fake_scheme)
         if os.path.exists(path):
             os.remove(path)
@@ -587,6 +715,39 @@ class HtmlGen:
 
 # less variables parsers
 
+# imported files cache: (parser, dirname, file) -> ((mtime, size), parsed items)
+# imports are resolved when the file is parsed, so unchanged partials are never read again
+imports_cache = {}
+
+def get_imported_items(parser, dirname, fname):
+    key = (parser, dirname, fname)
+    try:
+        st = os.stat(fname)
+    except OSError:
+        imports_cache.pop(key, None)
+        return None
+    stamp = (st.st_mtime, st.st_size)
+    entry = imports_cache.get(key)
+    if entry is None or entry[0] != stamp:
+        entry = (stamp, parser(dirname, fname, read_file(fname)))
+        imports_cache[key] = entry
+    return entry[1]
+
+def collect_vars(parser, dirname, items, cols, stack):
+    for item in items:
+        if item[0] == "var":
+            cols[item[1]] = item[2]
+            continue
+        name = item[1]
+        if name in stack:
+            continue # import cycle
+        sub = get_imported_items(parser, dirname, name)
+        if sub is None:
+            continue
+        stack.add(name)
+        collect_vars(parser, dirname, sub, cols, stack)
+        stack.discard(name)
+
 import_regex = re.compile("[\"|\''](?P<name>.*)[\"|\'']")
 
 def extract_sass_name_val(line):
@@ -621,7 +782,8 @@ def extract_sass_fname(dirname, line):
         res = _extract_sass_fname(dirname, name, ".scss")
     return res
 
-def find_sass_vars(dirname, fname, text, cols):
+def parse_sass(dirname, fname, text):
+    items = []
     i = 0
     for line in map(lambda s: s.strip(), text.split("\n")):
         i += 1
@@ -631,7 +793,7 @@ def find_sass_vars(dirname, fname, text, cols):
         if line.startswith("@import"):
             name = extract_sass_fname(dirname, line)
             if name != None:
-                find_sass_vars(dirname, name, read_file(name), cols)
+                items.append(("import", name))
             continue
 
         if line[0] != "$":
@@ -639,7 +801,11 @@ def find_sass_vars(dirname, fname, text, cols):
 
         var, col, pos = extract_sass_name_val(line)
         if var != None:
-            cols[var] = {"col": col, "file": fname, "line": i - 1, "pos": pos}
+            items.append(("var", var, {"col": col, "file": fname, "line": i - 1, "pos": pos}))
+    return items
+
+def find_sass_vars(dirname, fname, text, cols):
+    collect_vars(parse_sass, dirname, parse_sass(dirname, fname, text), cols, set([fname]))
 
 
 def extract_less_name_val(line):
@@ -663,7 +829,8 @@ def extract_less_fname(dirname, line):
         return None
     return res
 
-def find_less_vars(dirname, fname, text, cols):
+def parse_less(dirname, fname, text):
+    items = []
     i = 0
     for line in map(lambda s: s.strip(), text.split("\n")):
         i += 1
@@ -673,12 +840,16 @@ def find_less_vars(dirname, fname, text, cols):
         if line.startswith("@import"):
             name = extract_less_fname(dirname, line)
             if name != None:
-                find_less_vars(dirname, name, read_file(name), cols)
+                items.append(("import", name))
             continue
 
         var, col, pos = extract_less_name_val(line)
         if var != None:
-            cols[var] = {"col": col, "file": fname, "line": i, "pos": pos}
+            items.append(("var", var, {"col": col, "file": fname, "line": i, "pos": pos}))
+    return items
+
+def find_less_vars(dirname, fname, text, cols):
+    collect_vars(parse_less, dirname, parse_less(dirname, fname, text), cols, set([fname]))
 
 
 def extract_styl_fname(dirname, line):
@@ -707,7 +878,8 @@ def extract_styl_name_val(line):
     col = line[pos+1:].strip()
     return var, col, line.find(col)
 
-def find_styl_vars(dirname, fname, text, cols):
+def parse_styl(dirname, fname, text):
+    items = []
     i = 0
     for line in map(lambda s: s.strip(), text.split("\n")):
         i += 1
@@ -717,12 +889,16 @@ def find_styl_vars(dirname, fname, text, cols):
         if line.startswith("@import"):
             name = extract_styl_fname(dirname, line)
             if name != None:
-                find_styl_vars(dirname, name, read_file(name), cols)
+                items.append(("import", name))
             continue
 
         var, col, pos = extract_styl_name_val(line)
         if var != None:
-            cols[var] = {"col": col, "file": fname, "line": i, "pos": pos}
+            items.append(("var", var, {"col": col, "file": fname, "line": i, "pos": pos}))
+    return items
+
+def find_styl_vars(dirname, fname, text, cols):
+    collect_vars(parse_styl, dirname, parse_styl(dirname, fname, text), cols, set([fname]))
 
 
 def get_doc_text(view):
@@ -745,25 +921,107 @@ def parse_stylesheet(view, colors):
         find_styl_vars(dirname, nm, text, colors)
 
 
+# gutter icons
+
+icon_size = 32
+icon_circle = (15.0, 16.0, ((15 - 8) ** 2 + (16 - 10) ** 2) ** 0.5) # center x, center y, radius
+icon_mask = None
+
+def get_icon_mask():
+    """Coverage of every icon pixel by the circle, computed once with 4x4 supersampling."""
+    global icon_mask
+    if icon_mask is not None:
+        return icon_mask
+    (cx, cy, r) = icon_circle
+    mask = []
+    for y in range(icon_size):
+        row = []
+        for x in range(icon_size):
+            hits = 0
+            for sy in range(4):
+                for sx in range(4):
+                    dx = x + (sx + 0.5) / 4 - cx
+                    dy = y + (sy + 0.5) / 4 - cy
+                    if dx * dx + dy * dy <= r * r:
+                        hits += 1
+            row.append(hits / 16.0)
+        mask.append(row)
+    icon_mask = mask
+    return mask
+
+def png_chunk(tag, data):
+    chunk = tag + data
+    return struct.pack("!I", len(data)) + chunk + struct.pack("!I", zlib.crc32(chunk) & 0xFFFFFFFF)
+
+def render_icon(col):
+    (r, g, b) = (int(col[1:3], 16), int(col[3:5], 16), int(col[5:7], 16))
+    a = int(col[7:9], 16) if len(col) > 7 else 255
+    raw = bytearray()
+    for row in get_icon_mask():
+        raw.append(0) # filter type
+        for cov in row:
+            raw.extend((r, g, b, int(cov * a + 0.5)))
+    return b"\x89PNG\r\n\x1a\n" + \
+        png_chunk(b"IHDR", struct.pack("!IIBBBBB", icon_size, icon_size, 8, 6, 0, 0, 0)) + \
+        png_chunk(b"IDAT", zlib.compress(bytes(raw), 9)) + \
+        png_chunk(b"IEND", b"")
+
+
+class IconsCache:
+    """LRU of the icons known to be on disk, plus icons rendered but not written yet."""
+
+    def __init__(self, size):
+        self.size = size
+        self.tick = 0
+        self.written = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def _touch(self, col):
+        self.tick += 1
+        self.written[col] = self.tick
+        if len(self.written) > self.size:
+            del self.written[min(self.written, key=self.written.get)]
+
+    def get(self, col):
+        with self.lock:
+            if col in self.written:
+                self._touch(col)
+                return True
+            return col in self.pending
+
+    def put(self, col, data=None):
+        with self.lock:
+            if data is None:
+                self._touch(col)
+            else:
+                self.pending[col] = data
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for col, data in pending.items():
+            write_bin_file(os.path.join(full_icons_path, "%s.png" % col[1:]), data)
+        with self.lock:
+            for col in pending.keys():
+                self._touch(col)
+
+icons_cache = IconsCache(1024)
+
 def create_icon(col):
-    fname = icons_path + col[1:]
-    if not fname.endswith(".png"):
-        fname += ".png"
-    full_name = os.path.join(full_icons_path, "%s.png" % col[1:])
-    if os.path.exists(full_name):
-        return fname
-    cmd = sublime.load_settings(settings_file).get("convert_util_path") + ' -type TrueColorMatte -channel RGBA -size 32x32 -alpha transparent xc:none -fill "%s" -draw "circle 15,16 8,10" png32:"%s"'
-    popen = subprocess.Popen(cmd % (col, full_name), stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    _, err = popen.communicate()
-    try:
-        err = err.decode("utf-8")
-    except UnicodeDecodeError as ex:
-        err = str(ex)
-    if err is not None and len(err) != 0:
-        print_error("convert error:\n" + err)
-    if os.path.exists(full_name):
+    fname = icons_path + col[1:] + ".png"
+    if icons_cache.get(col):
         return fname
-    return ""
+    if os.path.exists(os.path.join(full_icons_path, "%s.png" % col[1:])):
+        icons_cache.put(col)
+    else:
+        icons_cache.put(col, render_icon(col))
+    return fname
+
+def flush_icons():
+    """Writes all the icons created since the last flush, must be called before the icons are used."""
+    icons_cache.flush()
 
 
 # event handler, main logic
@@ -838,6 +1096,15 @@ class Logic:
             self.settings["color_formats"] = color_formats
             self.settings["color_fmts"] = list(map(get_format, color_formats))
 
+        ha_chunk_size = sets.get("ha_chunk_size")
+        if ha_chunk_size != self.settings["ha_chunk_size"]:
+            self.settings["ha_chunk_size"] = ha_chunk_size
+
+        ha_max_regions = sets.get("ha_max_regions")
+        if ha_max_regions != self.settings["ha_max_regions"]:
+            self.settings["ha_max_regions"] = ha_max_regions
+            self.on_activated(sublime.active_window().active_view())
+
         file_exts = sets.get("file_exts")
         if file_exts != self.settings["file_exts"]:
             self.settings["file_exts"] = file_exts
@@ -867,7 +1134,7 @@ class Logic:
         view_obj["html_gen"] = htmlGen
 
         view = view_obj["view"]
-        htmlGen.update()
+        htmlGen.update(view)
         htmlGen.update_view(view)
 
     # initers
@@ -887,7 +1154,7 @@ class Logic:
                 sets.set("icons_all", False)
             sublime.save_settings(settings_file)
 
-        for k in ["enabled", "style", "ha_style", "icons_all", "icons", "color_formats", "file_exts"]:
+        for k in ["enabled", "style", "ha_style", "icons_all", "icons", "ha_chunk_size", "ha_max_regions", "color_formats", "file_exts"]:
             self.settings[k] = sets.get(k)
 
         self.settings["color_fmts"] = list(map(get_format, self.settings["color_formats"]))
@@ -918,7 +1185,7 @@ class Logic:
         if cs is None:
             return False # ST2 hack
         htmlGen = self.get_html_gen(cs)
-        self.views[view.id()] = {"view": view, "vars": {}, "regions": [], "hl_all_regions": [], "settings" : {"color_scheme": cs}, "html_gen": htmlGen}
+        self.views[view.id()] = {"view": view, "vars": {}, "regions": {}, "hl_all_regions": {}, "hl_all_index": None, "hl_all_gen": 0, "settings" : {"color_scheme": cs}, "html_gen": htmlGen}
         view.settings().add_on_change("ColorHighlighter", lambda v=view: self.on_settings_change_view(v))
         htmlGen.update_view(view)
         return True
@@ -948,34 +1215,197 @@ class Logic:
 
         view_obj = self.views[view.id()]
 
-        view_obj["vars"] = {}
-        self.clean_hl_all_regions(view)
+        if not self.settings["enabled"] or not self.valid_fname(view.file_name()) or self.settings["ha_style"] == "disabled":
+            view_obj["vars"] = {}
+            self.clean_hl_all_regions(view)
+        else:
+            self.update_hl_all(view, view_obj)
 
-        if not self.settings["enabled"] or not self.valid_fname(view.file_name()):
+        self.on_selection_modified(view)
+
+    # highlight all colors pipeline: scanning runs on the async thread in chunks, visible lines first,
+    # regions are applied on the main thread after every chunk
+
+    def schedule_hl_all(self, cb, delay=0):
+        if get_version() < 3000:
+            sublime.set_timeout(cb, delay)
+        else:
+            sublime.set_timeout_async(cb, delay)
+
+    def update_hl_all(self, view, view_obj):
+        view_obj["hl_all_gen"] += 1
+        gen = view_obj["hl_all_gen"]
+        self.schedule_hl_all(lambda: self.scan_hl_all(view, view_obj, gen))
+
+    def scan_hl_all(self, view, view_obj, gen):
+        if gen != view_obj["hl_all_gen"]:
             return
 
-        if self.settings["ha_style"] != "disabled":
-            parse_stylesheet(view, view_obj["vars"])
+        col_vars = {}
+        parse_stylesheet(view, col_vars)
+        job = {"gen": gen, "vars": col_vars, "change_count": view.change_count(), "touched": set(), "first": True}
+
+        # the index is only reusable if everything but the text stayed the same
+        vals = sorted((k, v["col"]) for k, v in col_vars.items())
+        job["state"] = (self.settings["ha_style"], self.settings["icons_all"], self.get_arr_fmt(view), vals)
+        index = view_obj["hl_all_index"]
+        if index is not None and index["state"] != job["state"]:
+            index = None
+        job["clean"] = index is None
+        if index is not None and index["change_count"] == job["change_count"] and None not in index["matches"]:
+            job["lines"] = index["lines"]
+            job["matches"] = index["matches"]
+            sublime.set_timeout(lambda: self.apply_hl_all(view, view_obj, job, {}, {}, False), 0)
+            return
 
-            htmlGen = view_obj["html_gen"]
-            regs = view_obj["hl_all_regions"]
-
-            res = self.find_all(color_fmts_data["all"]["regex"], get_doc_text(view), view, htmlGen, view_obj["vars"])
-            if htmlGen.update():
-                htmlGen.update_view(view)
-            i = 0
-            flags = self.get_regions_ha_flags()
-            for s, e, col in res:
-                i += 1
-                st = "mon_CH_ALL_" + str(i)
-                if self.settings["ha_style"] != "none":
-                    regs.append(st)
-                    view.add_regions(st, [sublime.Region(s, e)], region_name(col), "", flags)
-                if self.settings["icons_all"]:
-                    regs.append(st + "-ico")
-                    view.add_regions(st + "-ico", [sublime.Region(s, e)], region_name(col) + "-ico", create_icon(col), sublime.HIDDEN)
+        lines = get_doc_text(view).split("\n")
+        if index is None:
+            old_lines, old_matches = [], []
+        else:
+            old_lines, old_matches = index["lines"], index["matches"]
+
+        # dirty lines are everything between the unchanged head and the unchanged tail
+        n, m = len(old_lines), len(lines)
+        top = 0
+        while top < n and top < m and old_lines[top] == lines[top]:
+            top += 1
+        bottom = 0
+        while bottom < n - top and bottom < m - top and old_lines[n - 1 - bottom] == lines[m - 1 - bottom]:
+            bottom += 1
+
+        # colors of the dirty lines, only their region sets need to be re-registered
+        for row in old_matches[top:n - bottom]:
+            if row is not None:
+                for _, _, col in row:
+                    job["touched"].add(col)
+
+        starts = []
+        pos = 0
+        for l in lines:
+            starts.append(pos)
+            pos += len(l) + 1
+        starts.append(pos)
+
+        job["lines"] = lines
+        job["starts"] = starts
+        job["matches"] = old_matches[:top] + [None] * (m - bottom - top) + old_matches[n - bottom:] # None is not scanned yet
+        self.scan_hl_all_chunk(view, view_obj, job)
+
+    def scan_hl_all_chunk(self, view, view_obj, job):
+        if job["gen"] != view_obj["hl_all_gen"]:
+            return
 
-        self.on_selection_modified(view)
+        matches = list(job["matches"])
+        starts = job["starts"]
+        pending = []
+        for row in range(len(matches)):
+            if matches[row] is not None:
+                continue
+            if starts[row + 1] - starts[row] > max_line_size + 1:
+                matches[row] = [] # isInColor ignores these lines, so don't pay for scanning them
+            else:
+                pending.append(row)
+        total = sum(len(ms) for ms in matches if ms is not None)
+
+        rows = []
+        if job["first"]:
+            vis = view.visible_region()
+            (r0, _) = view.rowcol(vis.begin())
+            (r1, _) = view.rowcol(vis.end())
+            rows = [row for row in pending if r0 <= row <= r1]
+        if len(rows) == 0:
+            size = 0
+            for row in pending:
+                rows.append(row)
+                size += starts[row + 1] - starts[row]
+                if size >= self.settings["ha_chunk_size"]:
+                    break
+        if total >= self.settings["ha_max_regions"]:
+            rows = []
+
+        # scan the chunk by runs of consecutive lines
+        touched = job["touched"]
+        job["touched"] = set()
+        htmlGen = view_obj["html_gen"]
+        i = 0
+        while i < len(rows):
+            j = i + 1
+            while j < len(rows) and rows[j] == rows[j - 1] + 1:
+                j += 1
+            (top, bottom) = (rows[i], rows[j - 1] + 1)
+            for row in range(top, bottom):
+                matches[row] = []
+            found = self.find_all(color_fmts_data["all"]["regex"], "\n".join(job["lines"][top:bottom]), view, htmlGen, job["vars"], starts[top])
+            for s, e, col in found:
+                row = bisect.bisect_right(starts, s, top, bottom) - 1
+                matches[row].append((s - starts[row], e - starts[row], col))
+                touched.add(col)
+            i = j
+
+        col_regs = {}
+        for col in touched:
+            col_regs[col] = []
+        if len(touched) != 0:
+            for row in range(len(matches)):
+                if matches[row] is None:
+                    continue
+                for s, e, col in matches[row]:
+                    if col in col_regs:
+                        col_regs[col].append(sublime.Region(starts[row] + s, starts[row] + e))
+
+        icons = {}
+        if self.settings["icons_all"]:
+            for col, rs in col_regs.items():
+                if len(rs) != 0:
+                    icons[col] = create_icon(col)
+            flush_icons()
+
+        job["matches"] = matches
+        more = len(rows) != 0 and len(rows) != len(pending)
+        sublime.set_timeout(lambda: self.apply_hl_all(view, view_obj, job, col_regs, icons, more), 0)
+
+    def apply_hl_all(self, view, view_obj, job, col_regs, icons, more):
+        if job["gen"] != view_obj["hl_all_gen"] or self.views.get(view.id()) is not view_obj:
+            return # stale results
+        if view.change_count() != job["change_count"]:
+            self.update_hl_all(view, view_obj) # the text changed while scanning
+            return
+
+        if job["clean"]:
+            self.erase_hl_all_regions(view, view_obj)
+            job["clean"] = False
+        view_obj["vars"] = job["vars"]
+        view_obj["hl_all_index"] = {
+            "state": job["state"],
+            "change_count": job["change_count"],
+            "lines": job["lines"],
+            "matches": job["matches"]
+        }
+        view_obj["html_gen"].update(view)
+        self.add_hl_all_regions(view, view_obj, col_regs, icons)
+        if job["first"]:
+            job["first"] = False
+            self.on_selection_modified(view)
+        if more:
+            self.schedule_hl_all(lambda: self.scan_hl_all_chunk(view, view_obj, job), 10)
+
+    def add_hl_all_regions(self, view, view_obj, col_regs, icons):
+        regs = view_obj["hl_all_regions"]
+        flags = self.get_regions_ha_flags()
+        for col, rs in col_regs.items():
+            st = "mon_CH_ALL_" + col[1:]
+            if len(rs) == 0:
+                for k in regs.pop(col, []):
+                    view.erase_regions(k)
+                continue
+            keys = []
+            if self.settings["ha_style"] != "none":
+                keys.append(st)
+                view.add_regions(st, rs, region_name(col), "", flags)
+            if self.settings["icons_all"]:
+                keys.append(st + "-ico")
+                view.add_regions(st + "-ico", rs, region_name(col) + "-ico", icons[col], sublime.HIDDEN)
+            regs[col] = keys
 
     def valid_fname(self, fname):
         if self.settings["file_exts"] == "all":
@@ -1001,30 +1431,38 @@ class Logic:
 
             htmlGen = view_obj["html_gen"]
             words = self._get_words(view, htmlGen, view_obj["vars"])
-            if htmlGen.update():
-                htmlGen.update_view(view)
+            htmlGen.update(view)
+
+            col_regs = {}
+            for w, col, _ in words:
+                col_regs.setdefault(col, []).append(w)
 
-            i = 0
             regs = view_obj["regions"]
             flags = self.get_regions_flags()
-            for w, col, _ in words:
-                i += 1
-                st = "mon_CH_" + str(i)
+            icons = {}
+            if self.settings["icons"]:
+                for col in col_regs.keys():
+                    icons[col] = create_icon(col)
+                flush_icons()
+            for col, rs in col_regs.items():
+                st = "mon_CH_" + col[1:]
+                keys = []
                 if self.settings["style"] != "none":
-                    regs.append(st)
-                    view.add_regions(st, [w], region_name(col), "", flags)
+                    keys.append(st)
+                    view.add_regions(st, rs, region_name(col), "", flags)
                 if self.settings["icons"]:
-                    regs.append(st + "-ico")
-                    view.add_regions(st + "-ico", [w], region_name(col) + "-ico", create_icon(col), sublime.HIDDEN)
+                    keys.append(st + "-ico")
+                    view.add_regions(st + "-ico", rs, region_name(col) + "-ico", icons[col], sublime.HIDDEN)
+                regs[col] = keys
 
 
-    def find_all(self, regex, text, view, htmlGen, col_vars):
+    def find_all(self, regex, text, view, htmlGen, col_vars, offset=0):
         res = []
         array_format = self.get_arr_fmt(view)
         m = regex.search(text)
         line = None
         while m:
-            r = sublime.Region(m.start()+1, m.start()+1)
+            r = sublime.Region(offset+m.start()+1, offset+m.start()+1)
             if line is None or r.begin() >= line.end():
                 line = view.line(r.begin())
             wd, col, var = isInColor(view, r, col_vars, array_format, line)
@@ -1033,27 +1471,29 @@ class Logic:
                 htmlGen.add_color(col)
             m = regex.search(text, m.end())
 
-        varss = list(col_vars.keys())
-        varss.sort(key=len, reverse=True)
-        symbols = list(colors.names_to_hex.keys()) + varss
-        tlen = len(text)
-        for k in symbols:
-            l = len(k)
-            pos = 0
-            ind = text.find(k, pos)
-            while ind != -1:
-                if (ind + l == tlen or text[ind + l] not in low_letters) and (ind == 0 or text[ind - 1] not in low_letters):
-                    r = sublime.Region(ind+1, ind+1)
-                    if line is None or r.begin() >= line.end():
-                        line = view.line(r.begin())
-                    wd, col, var = isInColor(view, sublime.Region(ind+1, ind+1), col_vars, array_format, line)
-                    if col is not None:
-                        res.append((wd.begin(), wd.end(), col))
-                        htmlGen.add_color(col)
-                pos = ind + l
-                ind = text.find(k, pos)
+        line = None
+        for ind, _ in self.get_names_matcher(col_vars).find_all(text):
+            r = sublime.Region(offset+ind+1, offset+ind+1)
+            if line is None or r.begin() < line.begin() or r.begin() >= line.end():
+                line = view.line(r.begin())
+            wd, col, var = isInColor(view, r, col_vars, array_format, line)
+            if col is not None:
+                res.append((wd.begin(), wd.end(), col))
+                htmlGen.add_color(col)
         return res
 
+    # names matchers cache, the automaton is rebuilt only when variables set changes
+    names_matchers = {}
+    def get_names_matcher(self, col_vars):
+        key = frozenset(col_vars.keys())
+        matcher = self.names_matchers.get(key)
+        if matcher is None:
+            if len(self.names_matchers) >= 16:
+                self.names_matchers.clear()
+            matcher = NamesMatcher(list(colors.names_to_hex.keys()) + list(key))
+            self.names_matchers[key] = matcher
+        return matcher
+
     def _get_regions_flags(self, style):
         if style == "default" or style == "filled":
             return 0
@@ -1079,15 +1519,22 @@ class Logic:
 
     def clean_regions(self, view):
         view_obj = self.views[view.id()]
-        for s in view_obj["regions"]:
-            view.erase_regions(s)
-        view_obj["regions"] = []
+        for keys in view_obj["regions"].values():
+            for s in keys:
+                view.erase_regions(s)
+        view_obj["regions"] = {}
 
     def clean_hl_all_regions(self, view):
         view_obj = self.views[view.id()]
-        for s in view_obj["hl_all_regions"]:
-            view.erase_regions(s)
-        view_obj["hl_all_regions"] = []
+        view_obj["hl_all_gen"] += 1
+        self.erase_hl_all_regions(view, view_obj)
+
+    def erase_hl_all_regions(self, view, view_obj):
+        for keys in view_obj["hl_all_regions"].values():
+            for s in keys:
+                view.erase_regions(s)
+        view_obj["hl_all_regions"] = {}
+        view_obj["hl_all_index"] = None
 
     def get_arr_fmt(self, view):
         array_format = False
@@ -1119,6 +1566,7 @@ class Logic:
         self.init()
         for k in self.views.keys():
             vo = self.views[k]
+            vo["hl_all_index"] = None
             set_scheme(vo["view"], vo["settings"]["color_scheme"])
         if files:
             for hg in self.color_schemes.keys():
@@ -331,18 +331,14 @@ class ResponseHandler(threading.Thread):
 
                 if isinstance(resp, Notification):
                     if isinstance(resp.params, AnalysisErrorsParams):
-                        # Make sure the right type is passed to the async
-                        # code. `resp` may point to a different object when
-                        # the async code finally has a chance to run.
-                        after(0, actions.show_errors,
-                              AnalysisErrorsParams.from_json(resp.params.to_json().copy())
-                              )
+                        # `resp.params` is bound now, so it's safe to hand
+                        # over even when `resp` points elsewhere by the time
+                        # the async code runs. Nothing modifies these.
+                        after(0, actions.show_errors, resp.params)
                         continue
 
                     if isinstance(resp.params, AnalysisNavigationParams):
-                        after(0, actions.handle_navigation_data,
-                              AnalysisNavigationParams.from_json(resp.params.to_json().copy())
-                              )
+                        after(0, actions.handle_navigation_data, resp.params)
                         continue
 
                     if isinstance(resp.params, CompletionResultsParams):
@@ -350,9 +346,7 @@ class ResponseHandler(threading.Thread):
                             if actx.request_id or (resp.params.id != actx.id):
                                 actx.invalidate_results()
                                 continue
-                        after(0, actions.handle_completions,
-                              CompletionResultsParams.from_json(resp.params.to_json().copy())
-                              )
+                        after(0, actions.handle_completions, resp.params)
 
                 if isinstance(resp, Response):
                     if isinstance(resp.result, ServerGetVersionResult):
@@ -368,7 +362,7 @@ class ResponseHandler(threading.Thread):
                             actx.request_id = None
 
                     if isinstance(resp.result, EditFormatResult):
-                        after(0, actions.handle_formatting, EditFormatResult.from_json(resp.result.to_json().copy()))
+                        after(0, actions.handle_formatting, resp.result)
                         continue
 
         except Exception as e:
@@ -392,6 +386,11 @@ class RequestHandler(threading.Thread):
             try:
                 item = self.server.requests.get(timeout=0.1)
 
+                # requests are queued as objects or plain dicts (internal
+                # signals and the like)
+                if hasattr(item, 'to_json'):
+                    item = item.to_json()
+
                 if item.get('_internal') == _SIGNAL_STOP:
                     _logger.info(
                         'RequestHandler is exiting by internal request')
@@ -425,7 +424,7 @@ class StdoutWatcher(threading.Thread):
                 _logger.error(msg)
                 continue
 
-            _logger.debug('data read from server: %s', repr(data))
+            _logger.debug('data read from server: %r', data)
 
             if not data:
                 if self.server.stdin.closed:
@@ -4,8 +4,8 @@
 
 import sublime
 
+import itertools
 import queue
-import json
 
 import threading
 
@@ -32,10 +32,14 @@ class AnalyzerQueue(queue.PriorityQueue):
 
     It automatically bumps up priority of requests/responses coming from or
     targeted at the current view.
+
+    Items are stored as they are, without being copied or serialized. Items
+    of the same priority come out in the order they were put in.
     '''
     def __init__(self, name, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.name = name
+        self.counter = itertools.count()
         self.lock_put = threading.Lock()
         self.lock_get = threading.Lock()
 
@@ -69,23 +73,28 @@ class AnalyzerQueue(queue.PriorityQueue):
         if self.is_active(view):
             return max((given - 50), TaskPriority.HIGHEST)
 
+        return given
+
     def put(self, data, priority=TaskPriority.DEFAULT, view=None, block=True,
             timeout=None):
                 with self.lock_put:
-                    _logger.debug("putting in %s: %s", self.name, repr(data))
+                    _logger.debug("putting in %s: %r", self.name, data)
                     priority = self.calculate_priority(view, priority)
-                    super().put((priority, json.dumps(data)), block, timeout)
+                    # the counter keeps items from ever being compared
+                    super().put((priority, next(self.counter), data), block, timeout)
 
     def get(self, block=True, timeout=None):
         with self.lock_get:
-            prio, data = super().get(block, timeout)
-            _logger.debug("getting in %s: %s", self.name, repr(data))
-            return json.loads(data)
+            prio, count, data = super().get(block, timeout)
+            _logger.debug("getting in %s: %r", self.name, data)
+            return data
 
 
 class RequestsQueue(AnalyzerQueue):
+    '''Holds requests for the analysis server.
+
+    Requests are queued as they are; they are turned into JSON only once,
+    when they are written to the server.
+    '''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-
-    def put(self, data, *args, **kwargs):
-        super().put(data.to_json(), *args, **kwargs)
@@ -1,10 +1,9 @@
-import tempfile
-import re
+import difflib
 import os
 
 import sublime
 import sublime_plugin
-from .git import git_root, GitTextCommand
+from .git import git_root, repo_state, main_thread, GitTextCommand
 
 
 class GitClearAnnotationCommand(GitTextCommand):
@@ -23,11 +22,28 @@ class GitToggleAnnotationsCommand(GitTextCommand):
             self.view.run_command('git_annotate')
 
 
+# Bumped on every change to a view; an annotation is only drawn if no newer
+# change has come in since it was started.
+annotation_gens = {}
+
+
 class GitAnnotationListener(sublime_plugin.EventListener):
     def on_modified(self, view):
         if not view.settings().get('live_git_annotations'):
             return
-        view.run_command('git_annotate')
+        gen = annotation_gens.get(view.id(), 0) + 1
+        annotation_gens[view.id()] = gen
+        delay = sublime.load_settings("Git.sublime-settings").get('annotations_delay', 250)
+        sublime.set_timeout(lambda: self.idle(view, gen), delay)
+
+    def idle(self, view, gen):
+        if annotation_gens.get(view.id()) != gen:
+            return
+        if view.window() is not None and view.settings().get('live_git_annotations'):
+            view.run_command('git_annotate')
+
+    def on_close(self, view):
+        annotation_gens.pop(view.id(), None)
 
     def on_load(self, view):
         s = sublime.load_settings("Git.sublime-settings")
@@ -35,74 +51,91 @@ class GitAnnotationListener(sublime_plugin.EventListener):
             view.run_command('git_annotate')
 
 
+# HEAD contents of annotated files, keyed by (root, path) and stored with the
+# HEAD sha they were read at
+head_blobs = {}
+
+
+def line_diff(old, new):
+    # Lines are compared as small ints, and the common head and tail are cut
+    # off first, so a typical edit only leaves a few lines for difflib.
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old]
+    b = [ids.setdefault(line, len(ids)) for line in new]
+    head = 0
+    while head < len(a) and head < len(b) and a[head] == b[head]:
+        head += 1
+    tail = 0
+    while tail < len(a) - head and tail < len(b) - head and a[-1 - tail] == b[-1 - tail]:
+        tail += 1
+    matcher = difflib.SequenceMatcher(None, a[head:len(a) - tail], b[head:len(b) - tail], autojunk=False)
+
+    diff = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        i1, i2, j1, j2 = i1 + head, i2 + head, j1 + head, j2 + head
+        if tag == 'insert':
+            diff.extend(['+', j] for j in range(j1, j2))
+        elif tag == 'replace':
+            # blank lines alone aren't worth marking as changed
+            if not any(line.strip() for line in old[i1:i2]):
+                diff.extend(['+', j] for j in range(j1, j2))
+            elif any(line.strip() for line in new[j1:j2]):
+                diff.extend(['x', j] for j in range(j1, j2) if new[j].strip())
+            else:
+                diff.append(['-', j2])
+        elif tag == 'delete' and any(line.strip() for line in old[i1:i2]):
+            diff.append(['-', j1])
+    return diff
+
+
 class GitAnnotateCommand(GitTextCommand):
-    # Unfortunately, git diff does not support text from stdin, making a *live*
-    # annotation difficult. Therefore I had to resort to the system diff
-    # command.
-    # This works as follows:
-    # 1. When the command is run for the first time for this file, a temporary
-    #    file with the current state of the HEAD is being pulled from git.
-    # 2. All consecutive runs will pass the current buffer into diffs stdin.
-    #    The resulting output is then parsed and regions are set accordingly.
+    # git diff does not support text from stdin, so the file as of HEAD is
+    # read once with git show and kept in memory. Every later run diffs the
+    # buffer against it in-process and sets the regions accordingly. The blob
+    # is read again only when HEAD moves.
     def run(self, view):
-        # If the annotations are already running, we dont have to create a new
-        # tmpfile
-        if hasattr(self, "tmp"):
-            self.compare_tmp(None)
-            return
-        self.tmp = tempfile.NamedTemporaryFile()
         self.active_view().settings().set('live_git_annotations', True)
         root = git_root(self.get_working_dir())
         repo_file = os.path.relpath(self.view.file_name(), root)
-        self.run_command(['git', 'show', 'HEAD:{0}'.format(repo_file)], show_status=False, no_save=True, callback=self.compare_tmp, stdout=self.tmp)
-
-    def compare_tmp(self, result, stdout=None):
-        all_text = self.view.substr(sublime.Region(0, self.view.size()))
-        self.run_command(['diff', '-u', self.tmp.name, '-'], stdin=all_text, no_save=True, show_status=False, callback=self.parse_diff)
+        state = repo_state(root)
+        head = state.head() if state else None
+        key = (root, repo_file)
+        # without a readable HEAD there's nothing to tell blobs apart by
+        if head is not None and key in head_blobs and head_blobs[key][0] == head:
+            self.compare(head_blobs[key][1])
+            return
+        self.run_command(['git', 'show', 'HEAD:{0}'.format(repo_file).replace(os.sep, '/')], show_status=False, no_save=True,
+            callback=self.blob_done, key=key, head=head)
 
-    # This is where the magic happens. At the moment, only one chunk format is supported. While
-    # the unified diff format theoritaclly supports more, I don't think git diff creates them.
-    def parse_diff(self, result, stdin=None):
+    def blob_done(self, result, key=None, head=None):
+        # a file that isn't in HEAD yet is all additions
+        if result.startswith('fatal:'):
+            result = ''
         lines = result.splitlines()
-        matcher = re.compile('^@@ -([0-9]*),([0-9]*) \+([0-9]*),([0-9]*) @@')
-        diff = []
-        for line_index in range(0, len(lines)):
-            line = lines[line_index]
-            if not line.startswith('@'):
-                continue
-            match = matcher.match(line)
-            if not match:
-                continue
-            line_before, len_before, line_after, len_after = [int(match.group(x)) for x in [1, 2, 3, 4]]
-            chunk_index = line_index + 1
-            tracked_line_index = line_after - 1
-            deletion = False
-            insertion = False
-            while True:
-                line = lines[chunk_index]
-                if line.startswith('@'):
-                    break
-                elif line.startswith('-'):
-                    if not line.strip() == '-':
-                        deletion = True
-                    tracked_line_index -= 1
-                elif line.startswith('+'):
-                    if deletion and not line.strip() == '+':
-                        diff.append(['x', tracked_line_index])
-                        insertion = True
-                    elif not deletion:
-                        insertion = True
-                        diff.append(['+', tracked_line_index])
-                else:
-                    if not insertion and deletion:
-                        diff.append(['-', tracked_line_index])
-                    insertion = deletion = False
-                tracked_line_index += 1
-                chunk_index += 1
-                if chunk_index >= len(lines):
-                    break
-
-        self.annotate(diff)
+        if head is not None:
+            if len(head_blobs) >= 64:
+                head_blobs.clear()
+            head_blobs[key] = (head, lines)
+        self.compare(lines)
+
+    def compare(self, lines):
+        view = self.view
+        gen = annotation_gens.get(view.id(), 0)
+        change_count = view.change_count()
+        all_text = view.substr(sublime.Region(0, view.size()))
+
+        def work():
+            diff = line_diff(lines, all_text.splitlines())
+            main_thread(apply, diff)
+
+        def apply(diff):
+            # drop results for text that has been edited since
+            if annotation_gens.get(view.id(), 0) != gen or view.change_count() != change_count:
+                return
+            if view.settings().get('live_git_annotations'):
+                self.annotate(diff)
+
+        sublime.set_timeout_async(work, 0)
 
     # Once we got all lines with their specific change types (either x, +, or - for
     # modified, added, or removed) we can create our regions and do the actual annotation.
@@ -113,18 +146,13 @@ class GitAnnotateCommand(GitTextCommand):
         typed_diff = {'x': [], '+': [], '-': []}
         for change_type, line in diff:
             if change_type == '-':
-                full_region = self.view.full_line(self.view.text_point(line - 1, 0))
-                position = full_region.begin()
-                for i in range(full_region.size()):
-                    typed_diff[change_type].append(sublime.Region(position + i))
+                # underline the line above the removed ones
+                typed_diff[change_type].append(self.view.full_line(self.view.text_point(line - 1, 0)))
             else:
-                point = self.view.text_point(line, 0)
-                region = self.view.full_line(point)
-                if change_type == '-':
-                    region = sublime.Region(point, point + 5)
-                typed_diff[change_type].append(region)
+                typed_diff[change_type].append(self.view.full_line(self.view.text_point(line, 0)))
 
         for change in ['x', '+']:
             self.view.add_regions("git.changes.{0}".format(change), typed_diff[change], 'git.changes.{0}'.format(change), 'dot', sublime.HIDDEN)
 
-        self.view.add_regions("git.changes.-", typed_diff['-'], 'git.changes.-', 'dot', sublime.DRAW_EMPTY_AS_OVERWRITE)
+        self.view.add_regions("git.changes.-", typed_diff['-'], 'git.changes.-', 'dot',
+            sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE | sublime.DRAW_SOLID_UNDERLINE)
@@ -1,16 +1,60 @@
 import sublime, sublime_plugin
+import bisect
+import functools
 import os
 import re
 from .git import git_root, GitTextCommand, GitWindowCommand, do_when, goto_xy
 
 
-class GitDiff (object):
-    def run(self, edit=None, ignore_whitespace=False):
-        command = ['git', 'diff', '--no-color']
-        if ignore_whitespace:
-            command.extend(('--ignore-all-space', '--ignore-blank-lines'))
-        command.extend(('--', self.get_file_name()))
-        self.run_command(command, self.diff_done)
+class LargeDiff(object):
+    # Diffs are sized up with --numstat first. Small ones are shown as they
+    # always were; big ones start as a per-file summary, with the diffs of
+    # small files appended as they arrive and big files left collapsed until
+    # they are asked for.
+    def run_diff(self, command, paths):
+        s = sublime.load_settings("Git.sublime-settings")
+        if not s.get('diff_large_lines'):
+            self.run_command(command + ['--'] + paths, self.diff_done)
+            return
+        self.diff_command = command
+        # -z keeps paths unquoted, so they can be passed back to git as is
+        self.run_command(command + ['--numstat', '-z', '--no-renames', '--'] + paths,
+            self.numstat_done, paths=paths)
+
+    def numstat_done(self, result, paths=None):
+        s = sublime.load_settings("Git.sublime-settings")
+        stats = []
+        for line in result.split('\0'):
+            parts = line.split('\t', 2)
+            if len(parts) != 3:
+                continue
+            added, deleted, path = parts
+            # binary files show "-" for both
+            stats.append((int(added) if added.isdigit() else 0, int(deleted) if deleted.isdigit() else 0, path))
+
+        if sum(a + d for a, d, path in stats) <= s.get('diff_large_lines'):
+            self.run_command(self.diff_command + ['--'] + paths, self.diff_done)
+            return
+
+        collapse = s.get('diff_collapse_lines', 1000)
+        summary = ["Large diff: %d files changed, %d insertions(+), %d deletions(-)" % (
+            len(stats), sum(a for a, d, path in stats), sum(d for a, d, path in stats)), ""]
+        summary.extend("%8s %8s  %s" % ("+%d" % a, "-%d" % d, path) for a, d, path in stats)
+        summary.append("")
+        summary.extend(collapsed_line(a, d, path) for a, d, path in stats if a + d > collapse)
+        summary.append("")
+
+        root = git_root(self.get_working_dir())
+        view = self.scratch("\n".join(summary) + "\n", title="Git Diff",
+            syntax=s.get("diff_syntax", "Packages/Diff/Diff.tmLanguage"))
+        view.settings().set("git_root_dir", root)
+        view.settings().set("git_large_diff", True)
+        view.settings().set("git_diff_command", self.diff_command)
+
+        small = [path for a, d, path in stats if a + d <= collapse]
+        for i in range(0, len(small), 100):
+            self.run_command(self.diff_command + ['--no-renames', '--'] + small[i:i + 100],
+                functools.partial(append_output, view), working_dir=root, show_status=False)
 
     def diff_done(self, result):
         if not result.strip():
@@ -25,15 +69,38 @@ class GitDiff (object):
 
         # Store the git root directory in the view so we can resolve relative paths
         # when the user wants to navigate to the source file.
-        view.settings().set("git_root_dir", git_root(self.get_working_dir()))
+        if view:
+            view.settings().set("git_root_dir", git_root(self.get_working_dir()))
+
+
+def collapsed_line(added, deleted, path):
+    return "### %s (+%d -%d, press enter to load)" % (path, added, deleted)
+
+
+def append_output(view, output, replace=None):
+    if not view.window():
+        return
+    if replace is None:
+        replace = [view.size(), view.size()]
+    view.set_read_only(False)
+    view.run_command('git_scratch_output', {'output': output, 'replace': replace})
+    view.set_read_only(True)
+
+
+class GitDiff (LargeDiff):
+    def run(self, edit=None, ignore_whitespace=False):
+        command = ['git', 'diff', '--no-color']
+        if ignore_whitespace:
+            command.extend(('--ignore-all-space', '--ignore-blank-lines'))
+        self.run_diff(command, [self.get_file_name()])
 
 
-class GitDiffCommit (object):
+class GitDiffCommit (LargeDiff):
     def run(self, edit=None, ignore_whitespace=False):
         command = ['git', 'diff', '--cached', '--no-color']
         if ignore_whitespace:
             command.extend(('--ignore-all-space', '--ignore-blank-lines'))
-        self.run_command(command, self.diff_done)
+        self.run_diff(command, [])
 
     def diff_done(self, result):
         if not result.strip():
@@ -44,6 +111,30 @@ class GitDiffCommit (object):
         self.scratch(result, title="Git Diff", syntax=syntax)
 
 
+class GitDiffExpandCommand(GitTextCommand):
+    # loads the diff of a file collapsed by LargeDiff
+    def is_enabled(self):
+        return bool(self.view.settings().get("git_large_diff"))
+
+    def run(self, edit):
+        line = self.view.line(self.view.sel()[0].a)
+        text = self.view.substr(line)
+        if not text.startswith("### ") or not text.endswith(", press enter to load)"):
+            return
+        path = text[4:].rpartition(" (+")[0]
+        self.view.set_read_only(False)
+        self.view.replace(edit, line, "### %s (loading...)" % path)
+        self.view.set_read_only(True)
+        self.run_command(self.view.settings().get("git_diff_command") + ['--no-renames', '--', path],
+            self.expand_done, working_dir=self.view.settings().get("git_root_dir"), path=path)
+
+    def expand_done(self, result, path=None):
+        region = self.view.find("### %s (loading...)" % path, 0, sublime.LITERAL)
+        if region.empty():
+            return
+        append_output(self.view, result.rstrip("\n"), [region.a, region.b])
+
+
 class GitDiffCommand(GitDiff, GitTextCommand):
     pass
 
@@ -56,6 +147,78 @@ class GitDiffCommitCommand(GitDiffCommit, GitWindowCommand):
     pass
 
 
+# Hunk indexes of diff views, keyed by view id; an index is rebuilt only
+# when the view's text has changed since it was made
+hunk_indexes = {}
+hunk_header = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class HunkIndex(object):
+    def __init__(self, text):
+        # offsets of the hunk header lines, and (file name, new start line)
+        # for each of them
+        self.starts = []
+        self.hunks = []
+        file_name = None
+        previous = ''
+        offset = 0
+        for line in text.split('\n'):
+            if line.startswith('+++ ') and previous.startswith('--- '):
+                file_name = line[6:].strip() if line.startswith('+++ b/') else None
+            elif line.startswith('@@'):
+                match = hunk_header.match(line)
+                if match:
+                    self.starts.append(offset)
+                    self.hunks.append((file_name, int(match.group(3))))
+            previous = line
+            offset += len(line) + 1
+
+    def find(self, point):
+        # index of the hunk containing point, or None
+        i = bisect.bisect_right(self.starts, point) - 1
+        return i if i >= 0 else None
+
+
+def hunk_index(view):
+    cached = hunk_indexes.get(view.id())
+    if cached and cached[0] == view.change_count():
+        return cached[1]
+    if len(hunk_indexes) >= 64:
+        hunk_indexes.clear()
+    index = HunkIndex(view.substr(sublime.Region(0, view.size())))
+    hunk_indexes[view.id()] = (view.change_count(), index)
+    return index
+
+
+def is_diff_view(view):
+    # cheap checks first: this runs whenever the command palette opens
+    settings = view.settings()
+    if settings.get("git_root_dir") or settings.get("git_large_diff"):
+        return True
+    return "Diff" in (settings.get("syntax") or "")
+
+
+class GitGotoHunkCommand(sublime_plugin.TextCommand):
+    def is_enabled(self, forward=True):
+        return is_diff_view(self.view) and bool(hunk_index(self.view).starts)
+
+    def run(self, edit, forward=True):
+        if not is_diff_view(self.view):
+            return
+        index = hunk_index(self.view)
+        point = self.view.sel()[0].a
+        if forward:
+            i = bisect.bisect_right(index.starts, point)
+        else:
+            i = bisect.bisect_left(index.starts, point) - 1
+        if not 0 <= i < len(index.starts):
+            return
+        target = index.starts[i]
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(target))
+        self.view.show(target)
+
+
 class GitGotoDiff(sublime_plugin.TextCommand):
     def __init__(self, view):
         self.view = view
@@ -73,31 +236,19 @@ class GitGotoDiff(sublime_plugin.TextCommand):
         pt = v.line(beg).a          # First position in the current diff line
         self.column = beg - pt - 1  # The current column (-1 because the first char in diff file)
 
-        self.file_name = None
-        hunk_line = None
-        line_offset = 0
-
-        while pt > 0:
-            line = v.line(pt)
-            lineContent = v.substr(line)
-            if lineContent.startswith("@@"):
-                if not hunk_line:
-                    hunk_line = lineContent
-            elif lineContent.startswith("+++ b/"):
-                self.file_name = v.substr(sublime.Region(line.a+6, line.b)).strip()
-                break
-            elif not hunk_line and not lineContent.startswith("-"):
-                line_offset = line_offset+1
-
-            pt = v.line(pt-1).a
-
-        hunk = re.match(r"^@@ -(\d+),(\d+) \+(\d+),(\d+) @@.*", hunk_line)
-        if not hunk:
+        index = hunk_index(v)
+        hunk = index.find(pt)
+        if hunk is None:
             sublime.status_message("No hunk info")
             return
+        self.file_name, hunk_start_line = index.hunks[hunk]
+        if not self.file_name:
+            return
 
-        hunk_start_line = hunk.group(3)
-        self.goto_line = int(hunk_start_line) + line_offset - 1
+        # count the lines of the new file from the hunk header down to here
+        body = v.substr(sublime.Region(v.line(index.starts[hunk]).b + 1, v.line(beg).b))
+        line_offset = len([line for line in body.split('\n') if not line.startswith('-')])
+        self.goto_line = hunk_start_line + line_offset - 1
 
         git_root_dir = v.settings().get("git_root_dir")
 
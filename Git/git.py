@@ -6,12 +6,16 @@ import subprocess
 import functools
 import os.path
 import time
+import queue
+import traceback
+import re
 
 # In a complete inversion from ST2, in ST3 when a plugin is loaded we
 # actually can trust __file__.
 # Goal is to get: "Packages/Git", allowing for people who rename things
 
 git_root_cache = {}
+git_root_lock = threading.Lock()
 
 def find_plugin_directory(f):
     dirname = os.path.split(os.path.dirname(f))[-1]
@@ -30,15 +34,22 @@ def open_url(url):
 
 
 def git_root(directory):
-    global git_root_cache
+    # Every directory passed on the way up is cached with the root that was
+    # found, so other files in the same tree don't have to walk again. A
+    # cached root is dropped early if its .git disappears. Misses are only
+    # kept for a few seconds.
+    now = time.time()
+    with git_root_lock:
+        cached = git_root_cache.get(directory)
+    if cached and cached['expires'] > now:
+        retval = cached['retval']
+        if os.path.exists(os.path.join(retval or directory, '.git')) != (not retval):
+            return retval
 
     retval = False
-    leaf_dir = directory
-
-    if leaf_dir in git_root_cache and git_root_cache[leaf_dir]['expires'] > time.time():
-        return git_root_cache[leaf_dir]['retval']
-
+    walked = []
     while directory:
+        walked.append(directory)
         if os.path.exists(os.path.join(directory, '.git')):
             retval = directory
             break
@@ -48,11 +59,29 @@ def git_root(directory):
             retval = False
             break
         directory = parent
+        with git_root_lock:
+            cached = git_root_cache.get(directory)
+        if cached and cached['expires'] > now and cached['retval']:
+            retval = cached['retval']
+            if os.path.exists(os.path.join(retval, '.git')):
+                break
+            retval = False
 
-    git_root_cache[leaf_dir] = {
-        'retval': retval,
-        'expires': time.time() + 5
-    }
+    if retval:
+        ttl = sublime.load_settings("Git.sublime-settings").get('git_root_cache_seconds', 60)
+    else:
+        # a miss would be hidden by a `git init` further up, which no single
+        # stat can notice; remember it only briefly and only for the leaf
+        ttl = 5
+        walked = walked[:1]
+    with git_root_lock:
+        if len(git_root_cache) > 4096:
+            git_root_cache.clear()
+        for walked_dir in walked:
+            git_root_cache[walked_dir] = {
+                'retval': retval,
+                'expires': now + ttl
+            }
 
     return retval
 
@@ -62,6 +91,150 @@ def git_root_exist(directory):
     return git_root(directory)
 
 
+def git_dir(root):
+    # .git is a file pointing elsewhere for worktrees and submodules
+    path = os.path.join(root, '.git')
+    if os.path.isfile(path):
+        try:
+            with open(path) as f:
+                line = f.readline().strip()
+        except (IOError, OSError):
+            return path
+        if line.startswith('gitdir:'):
+            return os.path.normpath(os.path.join(root, line[7:].strip()))
+    return path
+
+
+def is_sha(value):
+    return len(value) == 40 and all(c in '0123456789abcdef' for c in value)
+
+
+def _mtime(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+
+class RepoState(object):
+    # Values computed by running git against a repository (branch, status,
+    # ...), kept until something under .git changes. Checking is a handful
+    # of stat calls, which is much cheaper than spawning git.
+    def __init__(self, root):
+        self.root = root
+        self.git_dir = git_dir(root)
+        # a linked worktree keeps only HEAD, index and a few per-worktree
+        # refs in its own dir; branches and packed-refs are shared
+        self.common_dir = self.git_dir
+        try:
+            with open(os.path.join(self.git_dir, 'commondir')) as f:
+                common = f.read().strip()
+        except (IOError, OSError):
+            common = None
+        if common:
+            self.common_dir = os.path.normpath(os.path.join(self.git_dir, common))
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def head_ref(self):
+        try:
+            with open(os.path.join(self.git_dir, 'HEAD')) as f:
+                head = f.read().strip()
+        except (IOError, OSError):
+            return None
+        if head.startswith('ref:'):
+            return head[4:].strip()
+        return None
+
+    def path(self, name):
+        # where a ref (or HEAD, index, packed-refs) lives on disk
+        if name.startswith(('refs/bisect/', 'refs/worktree/', 'refs/rewritten/')):
+            return os.path.join(self.git_dir, name)
+        if name.startswith('refs') or name == 'packed-refs':
+            return os.path.join(self.common_dir, name)
+        return os.path.join(self.git_dir, name)
+
+    def head(self):
+        return self.resolve('HEAD')
+
+    def resolve(self, name):
+        # sha a ref (HEAD, a branch, tag or remote branch) points to, read
+        # straight from the ref files; None if it can't be worked out
+        if is_sha(name):
+            return name
+        # besides full refs only pseudo-refs (HEAD, FETCH_HEAD, ...) are
+        # looked up as is; other names in .git are files like index or config
+        candidates = [name] if name.startswith('refs/') or re.match(r'^[A-Z_]+$', name) else []
+        if name != 'HEAD':
+            candidates += [prefix + name for prefix in ('refs/', 'refs/tags/', 'refs/heads/', 'refs/remotes/')]
+        for ref in candidates:
+            try:
+                with open(self.path(ref)) as f:
+                    value = f.read().strip()
+            except (IOError, OSError, UnicodeDecodeError):
+                continue
+            if value.startswith('ref:'):
+                return self.resolve(value[4:].strip())
+            # FETCH_HEAD has a sha and a description on each line
+            value = value.split()[0] if value else value
+            if is_sha(value):
+                return value
+        try:
+            with open(self.path('packed-refs')) as f:
+                packed = dict(reversed(line.split()) for line in f if len(line.split()) == 2)
+        except (IOError, OSError, UnicodeDecodeError):
+            return None
+        for ref in candidates:
+            if is_sha(packed.get(ref, '')):
+                return packed[ref]
+        return None
+
+    def stamp(self):
+        paths = ['HEAD', 'index', 'refs', 'refs/heads', 'packed-refs']
+        ref = self.head_ref()
+        if ref:
+            paths.append(ref)
+        return tuple(_mtime(self.path(p)) for p in paths)
+
+    def get(self, key, max_age=None):
+        with self.lock:
+            entry = self.values.get(key)
+        if entry is None:
+            return None
+        value, stamp, created = entry
+        if max_age is not None and time.time() - created > max_age:
+            return None
+        if stamp != self.stamp():
+            return None
+        return value
+
+    def set(self, key, value, stamp=None):
+        # pass the stamp taken before running git, so a change made while
+        # the command ran isn't hidden behind the old result
+        if stamp is None:
+            stamp = self.stamp()
+        with self.lock:
+            self.values[key] = (value, stamp, time.time())
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+
+repo_states = {}
+
+
+def repo_state(root):
+    if not root:
+        return None
+    if root not in repo_states:
+        repo_states[root] = RepoState(root)
+    return repo_states[root]
+
+
 def view_contents(view):
     region = sublime.Region(0, view.size())
     return view.substr(region)
@@ -158,9 +331,6 @@ class CommandThread(threading.Thread):
             if not os.path.isdir(self.working_dir):
                 return
 
-            if self.working_dir != "":
-                os.chdir(self.working_dir)
-
             # Windows needs startupinfo in order to start process in background
             startupinfo = None
             if os.name == 'nt':
@@ -175,7 +345,8 @@ class CommandThread(threading.Thread):
             proc = subprocess.Popen(self.command,
                 stdout=self.stdout, stderr=subprocess.STDOUT,
                 stdin=subprocess.PIPE, startupinfo=startupinfo,
-                shell=shell, universal_newlines=False)
+                shell=shell, universal_newlines=False,
+                cwd=self.working_dir or None)
             output = proc.communicate(self.stdin)[0]
             if not output:
                 output = ''
@@ -191,11 +362,86 @@ class CommandThread(threading.Thread):
                 raise e
 
 
+class CommandPool(object):
+    # Runs commands on a bounded number of worker threads. Identical commands
+    # that are already queued or running for the same directory are not run
+    # again: every caller gets the result of the one process.
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.workers = 0
+
+    def size(self):
+        return max(1, sublime.load_settings("Git.sublime-settings").get('command_threads', 4))
+
+    def run(self, command, on_done, working_dir="", fallback_encoding="", **kwargs):
+        # commands writing to a custom stdout can't share their output
+        key = None
+        if "stdout" not in kwargs:
+            key = (tuple(command), working_dir, fallback_encoding, kwargs.get("stdin"))
+
+        with self.lock:
+            if key in self.in_flight:
+                self.in_flight[key].append((on_done, kwargs))
+                return
+            waiters = [(on_done, kwargs)]
+            if key is not None:
+                self.in_flight[key] = waiters
+
+        def done(result, **ignored):
+            self.release(key, waiters)
+            for callback, callback_kwargs in waiters:
+                callback(result, **callback_kwargs)
+
+        thread = CommandThread(command, done, working_dir, fallback_encoding, **kwargs)
+        self.jobs.put((thread, key, waiters))
+
+        with self.lock:
+            if self.workers < self.size():
+                self.workers += 1
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+
+    def release(self, key, waiters):
+        with self.lock:
+            if key is not None and self.in_flight.get(key) is waiters:
+                del self.in_flight[key]
+
+    def work(self):
+        while True:
+            try:
+                thread, key, waiters = self.jobs.get(timeout=30)
+            except queue.Empty:
+                with self.lock:
+                    if self.jobs.empty():
+                        self.workers -= 1
+                        return
+                continue
+            try:
+                thread.run()
+            except Exception:
+                # a failing command mustn't take the worker down with it,
+                # or the pool would eventually stop running anything
+                traceback.print_exc()
+            finally:
+                # if the command failed before calling back, let the next
+                # identical command run again
+                main_thread(self.release, key, waiters)
+
+command_pool = CommandPool()
+
+
 class GitScratchOutputCommand(sublime_plugin.TextCommand):
-    def run(self, edit, output = '', output_file = None, clear = False):
+    def run(self, edit, output = '', output_file = None, clear = False, replace = None):
         if clear:
             region = sublime.Region(0, self.view.size())
             self.view.erase(edit, region)
+        if replace:
+            # replace part of the output, e.g. to append or expand something
+            self.view.replace(edit, sublime.Region(replace[0], replace[1]), output)
+            return
         self.view.insert(edit, 0, output)
 
 
@@ -204,7 +450,7 @@ class GitCommand(object):
     may_change_files = False
 
     def run_command(self, command, callback=None, show_status=True,
-            filter_empty_args=True, no_save=False, **kwargs):
+            filter_empty_args=True, no_save=False, detached=False, **kwargs):
         if filter_empty_args:
             command = [arg for arg in command if arg]
         if 'working_dir' not in kwargs:
@@ -228,14 +474,23 @@ class GitCommand(object):
         if not callback:
             callback = self.generic_done
 
-        thread = CommandThread(command, callback, **kwargs)
-        thread.start()
+        if detached:
+            # long-lived programs (e.g. gitk) get a thread of their own
+            # instead of holding one of the pool workers
+            thread = CommandThread(command, callback, **kwargs)
+            thread.start()
+        else:
+            command_pool.run(command, callback, **kwargs)
 
         if show_status:
             message = kwargs.get('status_message', False) or ' '.join(command)
             sublime.status_message(message)
 
     def generic_done(self, result):
+        if self.may_change_files:
+            state = repo_state(git_root(self.get_working_dir()))
+            if state:
+                state.invalidate()
         if self.may_change_files and self.active_view() and self.active_view().file_name():
             if self.active_view().is_dirty():
                 result = "WARNING: Current view is dirty.\n\n"
@@ -443,13 +698,13 @@ class GitRawCommand(GitWindowCommand):
 class GitGuiCommand(GitTextCommand):
     def run(self, edit):
         command = ['git', 'gui']
-        self.run_command(command)
+        self.run_command(command, detached=True)
 
 
 class GitGitkCommand(GitTextCommand):
     def run(self, edit):
         command = ['gitk']
-        self.run_command(command)
+        self.run_command(command, detached=True)
 
 
 class GitUpdateIgnoreCommand(sublime_plugin.TextCommand):
@@ -1,29 +1,146 @@
 import sublime_plugin
-import functools
+import array
+import os
 import re
+import time
 
 import sublime
-from .git import GitTextCommand, GitWindowCommand, plugin_file
+from .git import GitTextCommand, GitWindowCommand, git_root, repo_state, plugin_file
+
+
+# Whole-file blames, keyed by file path. Each one is stored with the HEAD sha
+# and the file's mtime and size it was made for; range blames are sliced out
+# of it.
+blame_cache = {}
+blame_header = re.compile(r'^([0-9a-f]{40}) (\d+) (\d+) (\d+)$')
+
+
+def blame_stamp(root, path):
+    # None when HEAD can't be resolved: the blame can't be cached then
+    state = repo_state(root)
+    head = state.head() if state else None
+    if head is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (head, st.st_mtime, st.st_size)
+
+
+class Blame(object):
+    # A parsed `git blame --porcelain --incremental`: for each line the index
+    # of its commit and of the file it came from, plus the shared tables.
+    def __init__(self, stamp):
+        self.stamp = stamp
+        self.commits = []
+        self.commit_index = {}
+        self.filenames = []
+        self.lines = array.array('i')
+        self.files = array.array('i')
+
+    def parse(self, result):
+        current = None
+        for line in result.splitlines():
+            match = blame_header.match(line)
+            if match:
+                sha = match.group(1)
+                if sha not in self.commit_index:
+                    self.commit_index[sha] = len(self.commits)
+                    self.commits.append({'sha': sha})
+                current = self.commit_index[sha]
+                first, count = int(match.group(3)) - 1, int(match.group(4))
+                continue
+            if current is None:
+                continue
+            key, _, value = line.partition(' ')
+            if key == 'filename':
+                if value not in self.filenames:
+                    self.filenames.append(value)
+                end = first + count
+                if len(self.lines) < end:
+                    self.lines.extend([-1] * (end - len(self.lines)))
+                    self.files.extend([-1] * (end - len(self.files)))
+                for n in range(first, end):
+                    self.lines[n] = current
+                    self.files[n] = self.filenames.index(value)
+            elif key == 'boundary':
+                self.commits[current]['boundary'] = True
+            elif key in ('author', 'author-time', 'author-tz', 'summary'):
+                self.commits[current][key] = value
+        return self
+
+    def format(self, contents, begin, end, path):
+        # mimic plain `git blame` output, which the Git Blame syntax expects
+        rows = range(begin - 1, min(end, len(self.lines), len(contents)))
+        authors = [self.commits[self.lines[n]].get('author', '') for n in rows]
+        author_width = max([len(a) for a in authors] or [0])
+        files = [self.filenames[self.files[n]] for n in rows]
+        show_files = any(f != path for f in files)
+        file_width = max([len(f) for f in files] or [0])
+        number_width = len(str(rows[-1] + 1)) if rows else 1
+        output = []
+        for i, n in enumerate(rows):
+            commit = self.commits[self.lines[n]]
+            sha = commit['sha'][:8]
+            if commit.get('boundary'):
+                sha = '^' + commit['sha'][:7]
+            tz = commit.get('author-tz', '+0000')
+            offset = (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60) * (-1 if tz[0] == '-' else 1)
+            date = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(commit.get('author-time', 0)) + offset))
+            output.append('%s %s(%s %s %s %s) %s' % (
+                sha,
+                files[i].ljust(file_width) + ' ' if show_files else '',
+                authors[i].ljust(author_width), date, tz,
+                str(n + 1).rjust(number_width), contents[n]))
+        return '\n'.join(output) + '\n'
 
 
 class GitBlameCommand(GitTextCommand):
     def run(self, edit):
+        lines = self.get_lines()
+        position = None if lines else self.view.viewport_position()
+
+        path = self.view.file_name()
+        root = git_root(self.get_working_dir())
+        blame = blame_cache.get(path)
+        if blame and blame.stamp is not None and blame.stamp == blame_stamp(root, path):
+            return self.show_blame(blame, lines, position)
+
         # somewhat custom blame command:
         # -w: ignore whitespace changes
         # -M: retain blame when moving lines
         # -C: retain blame when copying lines between files
-        command = ['git', 'blame', '-w', '-M', '-C']
-
-        lines = self.get_lines()
-        if lines:
-            command.extend(('-L', str(lines[0]) + ',' + str(lines[1])))
-            callback = self.blame_done
-        else:
-            callback = functools.partial(self.blame_done,
-                    position=self.view.viewport_position())
-
-        command.append(self.get_file_name())
-        self.run_command(command, callback)
+        # The whole file is blamed once and cached, ranges come from that.
+        command = ['git', 'blame', '--porcelain', '--incremental', '-w', '-M', '-C',
+            '--', self.get_file_name()]
+        request = {}
+        self.run_command(command, self.porcelain_done, request=request, lines=lines, position=position)
+        # run_command saves the file first, so stamp it afterwards
+        request['stamp'] = blame_stamp(root, path)
+
+    def porcelain_done(self, result, request=None, lines=None, position=None):
+        blame = Blame(request.get('stamp')).parse(result)
+        if not blame.commits:
+            # not blameable (untracked file, ...); show git's message
+            return self.blame_done(result, position=position)
+        if blame.stamp is not None:
+            if len(blame_cache) >= 64:
+                blame_cache.clear()
+            blame_cache[self.view.file_name()] = blame
+        self.show_blame(blame, lines, position)
+
+    def show_blame(self, blame, lines, position):
+        try:
+            with open(self.view.file_name(), 'rb') as f:
+                contents = f.read()
+        except (IOError, OSError):
+            return
+        contents = contents.decode('utf-8', 'replace').split('\n')
+        begin, end = lines or (1, len(blame.lines))
+        root = git_root(self.get_working_dir())
+        path = os.path.relpath(self.view.file_name(), root).replace(os.sep, '/')
+        self.blame_done(blame.format(contents, begin, end, path), position=position)
 
     def get_lines(self):
         selection = self.view.sel()[0]  # todo: multi-select support?
@@ -43,32 +160,85 @@ class GitBlameCommand(GitTextCommand):
                 syntax=plugin_file("syntax/Git Blame.tmLanguage"))
 
 
+# Log entries already loaded, keyed by (root, working dir, follow, args, sha
+# of the ref being logged)
+log_cache = {}
+
+
 class GitLog(object):
     def run(self, edit=None):
         fn = self.get_file_name()
         return self.run_log(fn != '', '--', fn)
 
     def run_log(self, follow, *args):
+        root = git_root(self.get_working_dir())
+        state = repo_state(root)
+        self.log_args = (follow, args)
+        # the first revision given (or HEAD) is what's being logged; paths
+        # are relative to the working dir, so that's part of the key too
+        ref = 'HEAD'
+        for arg in args:
+            if arg == '--':
+                break
+            if not arg.startswith('-'):
+                ref = arg
+                break
+        sha = state.resolve(ref) if state else None
+        self.log_key = (root, os.path.relpath(self.get_working_dir(), root) if root else None, follow, args, sha)
+        if sha is None:
+            self.results = []
+            self.log_complete = False
+            self.load_log_page()
+        elif self.log_key in log_cache:
+            results, complete = log_cache[self.log_key]
+            self.results = list(results)
+            self.log_complete = complete
+            self.show_log()
+        else:
+            self.results = []
+            self.log_complete = False
+            self.load_log_page()
+
+    def load_log_page(self):
         # the ASCII bell (\a) is just a convenient character I'm pretty sure
         # won't ever come up in the subject of the commit (and if it does then
         # you positively deserve broken output...)
-        # 9000 is a pretty arbitrarily chosen limit; picked entirely because
-        # it's about the size of the largest repo I've tested this on... and
-        # there's a definite hiccup when it's loading that
-        command = ['git', 'log', '--pretty=%s (%h)\a%an <%aE>\a%ad (%ar)',
-            '--date=local', '--max-count=9000', '--follow' if follow else None]
+        # The log is read a page at a time, so big repositories show up as
+        # quickly as small ones; one extra entry tells us if there's more.
+        follow, args = self.log_args
+        page_size = sublime.load_settings("Git.sublime-settings").get('log_page_size', 500)
+        command = ['git', 'log', '-z', '--pretty=%s (%h)\a%an <%aE>\a%ad (%ar)',
+            '--date=local', '--skip=%d' % len(self.results), '--max-count=%d' % (page_size + 1),
+            '--follow' if follow else None]
         command.extend(args)
         self.run_command(
             command,
-            self.log_done)
-
-    def log_done(self, result):
-        self.results = [r.split('\a', 2) for r in result.strip().split('\n')]
-        self.quick_panel(self.results, self.log_panel_done)
+            self.log_done,
+            page_size=page_size)
+
+    def log_done(self, result, page_size=None):
+        entries = [r.split('\a', 2) for r in result.strip('\0\n').split('\0') if r.strip()]
+        shown = len(self.results)
+        self.results.extend(entries[:page_size])
+        self.log_complete = len(entries) <= page_size
+        if self.log_key[-1] is not None:
+            if len(log_cache) >= 32:
+                log_cache.clear()
+            log_cache[self.log_key] = (list(self.results), self.log_complete)
+        self.show_log(shown)
+
+    def show_log(self, selected=0):
+        items = self.results
+        if not self.log_complete:
+            items = items + [["Load more...", "%d commits shown" % len(self.results), ""]]
+        self.quick_panel(items, self.log_panel_done, 0, selected)
 
     def log_panel_done(self, picked):
         if 0 > picked < len(self.results):
             return
+        if picked == len(self.results):
+            self.load_log_page()
+            return
         item = self.results[picked]
         # the commit hash is the last thing on the first line, in brackets
         ref = item[0].split(' ')[-1].strip('()')
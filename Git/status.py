@@ -2,16 +2,28 @@ import os
 import re
 
 import sublime
-from .git import GitWindowCommand, git_root
+from .git import GitWindowCommand, git_root, repo_state
 
 
 class GitStatusCommand(GitWindowCommand):
     force_open = False
 
     def run(self):
-        self.run_command(['git', 'status', '--porcelain'], self.status_done)
+        state = repo_state(git_root(self.get_working_dir()))
+        s = sublime.load_settings("Git.sublime-settings")
+        status = state and state.get('status', s.get("status_cache_seconds", 30))
+        if status is not None:
+            return self.show_results(status)
+        self.run_command(['git', 'status', '--porcelain'], self.status_done,
+            stamp=state and state.stamp())
+
+    def status_done(self, result, stamp=None):
+        state = repo_state(git_root(self.get_working_dir()))
+        if state and stamp:
+            state.set('status', result, stamp)
+        self.show_results(result)
 
-    def status_done(self, result):
+    def show_results(self, result):
         self.results = list(filter(self.status_filter, result.rstrip().split('\n')))
         if len(self.results):
             self.show_status_list()
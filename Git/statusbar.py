@@ -1,39 +1,200 @@
-import re
+import os
+import time
 
 import sublime
 import sublime_plugin
-from .git import GitTextCommand
+from .git import GitTextCommand, git_root, repo_state
 
 
 class GitBranchStatusListener(sublime_plugin.EventListener):
+    # Switching tabs or saving quickly fires many events; only the last one
+    # in each burst refreshes the status bar.
+    pending = {}
+
     def on_activated(self, view):
-        view.run_command("git_branch_status")
+        self.schedule(view)
 
     def on_post_save(self, view):
-        view.run_command("git_branch_status")
+        # saving changes the working tree, which .git doesn't record
+        if view.file_name():
+            state = repo_state(git_root(os.path.realpath(os.path.dirname(view.file_name()))))
+            if state:
+                state.invalidate('status')
+                state.invalidate('statusbar')
+        self.schedule(view)
+
+    def schedule(self, view):
+        delay = sublime.load_settings("Git.sublime-settings").get("statusbar_delay", 100)
+        gen = self.pending.get(view.id(), 0) + 1
+        self.pending[view.id()] = gen
+        sublime.set_timeout(lambda: self.refresh(view, gen), delay)
+
+    def refresh(self, view, gen):
+        if self.pending.get(view.id()) != gen:
+            return
+        del self.pending[view.id()]
+        if view.window() is not None:
+            view.run_command("git_branch_status")
+
+
+def parse_status(result):
+    # one pass over `git status --porcelain=v2 -z --branch`, counting the
+    # index (X) and working tree (Y) codes
+    branch = ''
+    index = {}
+    working = {}
+    entries = result.split('\0')
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        i += 1
+        kind = entry[:1]
+        if kind == '#':
+            if entry.startswith('# branch.head '):
+                branch = entry[14:]
+            continue
+        if kind in ('1', '2', 'u'):
+            x, y = entry[2], entry[3]
+            if kind == '2':
+                # renames and copies are followed by the original path
+                i += 1
+        elif kind == '?':
+            x = y = '?'
+        else:
+            continue
+        if x != '.':
+            index[x] = index.get(x, 0) + 1
+        if y != '.':
+            working[y] = working.get(y, 0) + 1
+    if branch == '(detached)':
+        branch = 'HEAD'
+    return branch, index, working
+
+
+def parse_legacy_status(branch, result):
+    # the same counters from `git status --porcelain -z`, for git before 2.11
+    index = {}
+    working = {}
+    entries = result.split('\0')
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        i += 1
+        if len(entry) < 4 or entry[2] != ' ':
+            continue
+        x, y = entry[0], entry[1]
+        if x in 'RC':
+            # renames and copies are followed by the original path
+            i += 1
+        if x != ' ':
+            index[x] = index.get(x, 0) + 1
+        if y != ' ':
+            working[y] = working.get(y, 0) + 1
+    return branch, index, working
+
+
+class StatusBarEngine(object):
+    # All views of a repository share one `git status` per refresh. Views
+    # asking while a refresh is queued or running just wait for it, and a
+    # repository is refreshed at most once every statusbar_interval ms.
+    def __init__(self):
+        self.waiting = {}
+        self.in_flight = {}
+        self.last = {}
+        # git binaries that turned out not to know --porcelain=v2
+        self.legacy = set()
+
+    def request(self, command, root):
+        s = sublime.load_settings("Git.sublime-settings")
+        state = repo_state(root)
+        cached = state.get('statusbar', s.get("status_cache_seconds", 30))
+        if cached is not None:
+            command.show(cached)
+            return
+        waiting = self.waiting.setdefault(root, [])
+        if command not in waiting:
+            waiting.append(command)
+        # a refresh that never called back (git missing, ...) doesn't block
+        # the repository forever
+        if root in self.in_flight and time.time() - self.in_flight[root] < 30:
+            return
+        self.in_flight[root] = time.time()
+        wait = self.last.get(root, 0) + s.get("statusbar_interval", 1000) / 1000.0 - time.time()
+        sublime.set_timeout(lambda: self.refresh(command, root), max(0, int(wait * 1000)))
+
+    def binary(self):
+        return sublime.load_settings("Git.sublime-settings").get('git_command') or 'git'
+
+    def refresh(self, command, root):
+        state = repo_state(root)
+        if self.binary() in self.legacy:
+            command.run_command(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], self.branch_done,
+                show_status=False, no_save=True, working_dir=root, root=root, stamp=state.stamp(), owner=command)
+        else:
+            command.run_command(['git', 'status', '--porcelain=v2', '-z', '--branch'], self.done,
+                show_status=False, no_save=True, working_dir=root, root=root, stamp=state.stamp(), owner=command)
+
+    def done(self, result, root=None, stamp=None, owner=None):
+        # with --branch the output has the branch headers, but stderr is
+        # mixed in so warnings may come before them
+        start = result.find('# branch.')
+        if start == -1:
+            # git before 2.11 rejects the option with a usage message;
+            # any other failure only affects this refresh
+            if 'porcelain' in result and ('usage:' in result or 'takes no value' in result):
+                self.legacy.add(self.binary())
+                self.refresh(owner, root)
+            else:
+                self.finish(root, stamp, None)
+            return
+        self.finish(root, stamp, parse_status(result[start:]))
+
+    def branch_done(self, result, root=None, stamp=None, owner=None):
+        if result.startswith('fatal:'):
+            self.finish(root, stamp, None)
+            return
+        owner.run_command(['git', 'status', '--porcelain', '-z'], self.legacy_done,
+            show_status=False, no_save=True, working_dir=root, root=root, stamp=stamp, branch=result.strip())
+
+    def legacy_done(self, result, root=None, stamp=None, branch=None):
+        self.finish(root, stamp, None if result.startswith('fatal:') else parse_legacy_status(branch, result))
+
+    def finish(self, root, stamp, status):
+        self.in_flight.pop(root, None)
+        self.last[root] = time.time()
+        if status is not None:
+            repo_state(root).set('statusbar', status, stamp)
+        for command in self.waiting.pop(root, []):
+            if command.view.window() is not None:
+                command.show(status)
+
+status_bar_engine = StatusBarEngine()
 
 
 class GitBranchStatusCommand(GitTextCommand):
     def run(self, view):
         s = sublime.load_settings("Git.sublime-settings")
-        if s.get("statusbar_branch"):
-            self.run_command(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], self.branch_done, show_status=False, no_save=True)
-        else:
+        root = git_root(self.get_working_dir())
+        if not s.get("statusbar_branch"):
             self.view.set_status("git-branch", "")
-        if (s.get("statusbar_status")):
-            self.run_command(['git', 'status', '--porcelain'], self.status_done, show_status=False, no_save=True)
-        else:
+        if not s.get("statusbar_status"):
             self.view.set_status("git-status", "")
+        if root and (s.get("statusbar_branch") or s.get("statusbar_status")):
+            status_bar_engine.request(self, root)
 
-    def branch_done(self, result):
-        self.view.set_status("git-branch", "git branch: " + result.strip())
-
-    def status_done(self, result):
-        lines = [line for line in result.splitlines() if re.match(r'^[ MADRCU?!]{1,2}\s+.*', line)]
-        index = [line[0] for line in lines if not line[0].isspace()]
-        working = [line[1] for line in lines if not line[1].isspace()]
-        self.view.set_status("git-status-index", "index: " + self.status_string(index))
-        self.view.set_status("git-status-working", "working: " + self.status_string(working))
+    def show(self, status):
+        if status is None:
+            # git failed; show nothing rather than a wrong status
+            for key in ("git-branch", "git-status-index", "git-status-working"):
+                self.view.erase_status(key)
+            return
+        s = sublime.load_settings("Git.sublime-settings")
+        branch, index, working = status
+        if s.get("statusbar_branch"):
+            self.view.set_status("git-branch", "git branch: " + branch)
+        if s.get("statusbar_status"):
+            self.view.set_status("git-status-index", "index: " + self.status_string(index))
+            self.view.set_status("git-status-working", "working: " + self.status_string(working))
 
     def status_string(self, statuses):
         s = sublime.load_settings("Git.sublime-settings")
@@ -41,18 +202,8 @@ class GitBranchStatusCommand(GitTextCommand):
         if not statuses:
             return symbols['clean']
         status = []
-        if statuses.count('M'):
-            status.append("%d%s" % (statuses.count('M'), symbols['modified']))
-        if statuses.count('A'):
-            status.append("%d%s" % (statuses.count('A'), symbols['added']))
-        if statuses.count('D'):
-            status.append("%d%s" % (statuses.count('D'), symbols['deleted']))
-        if statuses.count('?'):
-            status.append("%d%s" % (statuses.count('?'), symbols['untracked']))
-        if statuses.count('U'):
-            status.append("%d%s" % (statuses.count('U'), symbols['conflicts']))
-        if statuses.count('R'):
-            status.append("%d%s" % (statuses.count('R'), symbols['renamed']))
-        if statuses.count('C'):
-            status.append("%d%s" % (statuses.count('C'), symbols['copied']))
+        for code, name in (('M', 'modified'), ('A', 'added'), ('D', 'deleted'), ('?', 'untracked'),
+                ('U', 'conflicts'), ('R', 'renamed'), ('C', 'copied')):
+            if statuses.get(code):
+                status.append("%d%s" % (statuses[code], symbols[name]))
         return symbols['separator'].join(status)
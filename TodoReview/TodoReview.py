@@ -7,15 +7,25 @@ A SublimeText 3 plugin for reviewing todo (and other) comments within your code.
 
 import datetime
 import fnmatch
+import hashlib
 import io
 import itertools
+import json
+import mmap
 import os
 import re
 import sublime
 import sublime_plugin
+import subprocess
 import sys
 import threading
 import timeit
+import traceback
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 class Settings():
 
@@ -32,12 +42,87 @@ class Settings():
 		return self.proj.get(key, self.user.get(key, default))
 
 
+class Index():
+	"""
+	On-disk cache of the results of every scanned file, stored per project.
+	A file's results are reused while its mtime and size are unchanged.
+	"""
+
+	def __init__(self, window, patterns):
+		project = window.project_file_name() or '\n'.join(window.folders())
+		name = hashlib.md5(project.encode('utf-8')).hexdigest()
+		self.path = os.path.join(sublime.cache_path(), 'TodoReview', name + '.json')
+		self.patterns = hashlib.md5(json.dumps(patterns, sort_keys=True).encode('utf-8')).hexdigest()
+		self.stamps = {}
+		self.files = {}
+
+
+	def load(self):
+		"""
+		Reads the index from disk; called from the scan thread, as it can
+		be several megabytes for big projects
+		"""
+		try:
+			with io.open(self.path, 'r', encoding='utf-8') as f:
+				data = json.load(f)
+			if data.get('patterns') == self.patterns:
+				self.files = data.get('files', {})
+		except(IOError, ValueError):
+			pass
+
+
+	def get(self, p):
+		try:
+			st = os.stat(p)
+		except OSError:
+			return None
+
+		stamp = [st.st_mtime, st.st_size]
+		self.stamps[p] = stamp
+		entry = self.files.get(p)
+		if entry is None or entry[0] != stamp:
+			return None
+		return entry[1]
+
+
+	def put(self, p, items):
+		stamp = self.stamps.get(p)
+		if stamp is not None:
+			self.files[p] = [stamp, items]
+
+
+	def prune(self, roots, visited):
+		"""
+		Drops entries under the walked folders that the walk didn't visit,
+		i.e. files deleted, renamed or excluded since the last scan
+		"""
+		roots = tuple(os.path.join(r, '') for r in roots)
+		if not roots:
+			return
+		for p in list(self.files):
+			if p.startswith(roots) and p not in visited:
+				del self.files[p]
+
+
+	def save(self):
+		data = json.dumps({'patterns': self.patterns, 'files': self.files})
+		try:
+			if not os.path.isdir(os.path.dirname(self.path)):
+				os.makedirs(os.path.dirname(self.path))
+			with io.open(self.path, 'w', encoding='utf-8') as f:
+				f.write(data)
+		except(IOError, OSError):
+			pass
+
+
 class Engine():
 
-	def __init__(self, dirpaths, filepaths, view):
+	def __init__(self, dirpaths, filepaths, view, git=False, git_since='HEAD'):
 		self.view = view
 		self.dirpaths = dirpaths
 		self.filepaths = filepaths
+		self.git = git
+		self.git_since = git_since
 
 		if settings.get('case_sensitive', False):
 			case = 0
@@ -49,49 +134,191 @@ class Engine():
 		patt_folders = settings.get('exclude_folders', [])
 
 		match_patterns = '|'.join(patt_patterns.values())
-		match_files = [fnmatch.translate(p) for p in patt_files]
-		match_folders = [fnmatch.translate(p) for p in patt_folders]
+		match_files = '|'.join('(?:%s)' % fnmatch.translate(p) for p in patt_files)
+		match_folders = '|'.join('(?:%s)' % fnmatch.translate(p) for p in patt_folders)
 
 		self.patterns = re.compile(match_patterns, case)
 		self.priority = re.compile(r'\(([0-9]{1,2})\)')
-		self.exclude_files = [re.compile(p) for p in match_files]
-		self.exclude_folders = [re.compile(p) for p in match_folders]
+		self.exclude_files = re.compile(match_files) if match_files else None
+		self.exclude_folders = re.compile(match_folders) if match_folders else None
 
 		self.open = self.view.window().views()
 		self.open_files = [v.file_name() for v in self.open if v.file_name()]
 
+		encoding = settings.get('encoding', 'utf-8')
+		self.max_size = settings.get('max_file_size', 0)
+		self.binary_exts = set(e.lower() for e in settings.get('binary_extensions', []))
+		self.sniff = self.ascii_compatible(encoding)
+		self.prefix = self.sniff and self.compile_prefix(list(patt_patterns.values()), case, encoding) or None
+
+		self.seen_paths = set()
+		self.index = None
+		if settings.get('index_files', True) and hasattr(sublime, 'cache_path'):
+			skip = [self.max_size, sorted(self.binary_exts)]
+			self.index = Index(self.view.window(), [patt_patterns, case, encoding, skip])
+
+
+	def walked_roots(self):
+		"""
+		Folders whose every file goes through files(); a scan of the files
+		changed in git only sees some of them
+		"""
+		if self.git == 'changed':
+			return []
+		return [self.resolve(d) for d in self.dirpaths]
+
 
 	def files(self):
-		seen_paths = []
+		seen_paths = self.seen_paths = set()
 
-		for dirpath in self.dirpaths:
-			for dirp, dirnames, filepaths in os.walk(self.resolve(dirpath)):
+		def walk():
+			for filepath in self.filepaths:
+				yield filepath
 
-				if any(p.search(dirp) for p in self.exclude_folders):
+			for dirpath in self.dirpaths:
+				gitpaths = self.git_files(self.resolve(dirpath)) if self.git else None
+				if gitpaths is not None:
+					for filepath in gitpaths:
+						yield filepath
 					continue
 
-				for filepath in filepaths:
-					self.filepaths.append(os.path.join(dirp, filepath))
+				for dirp, dirnames, filepaths in os.walk(self.resolve(dirpath)):
+
+					if self.excluded(self.exclude_folders, dirp):
+						dirnames[:] = []
+						continue
 
+					# prune excluded folders before descending into them
+					dirnames[:] = [d for d in dirnames if not self.excluded(self.exclude_folders, os.path.join(dirp, d))]
 
-		for filepath in self.filepaths:
+					for filepath in filepaths:
+						yield os.path.join(dirp, filepath)
+
+		for filepath in walk():
 			p = self.resolve(filepath)
 			if p in seen_paths:
 				continue
 
-			if any(p.search(filepath) for p in self.exclude_folders):
+			if self.excluded(self.exclude_folders, filepath):
 				continue
 
-			if any(p.search(filepath) for p in self.exclude_files):
+			if self.excluded(self.exclude_files, filepath):
 				continue
 
-			seen_paths.append(p)
+			seen_paths.add(p)
 			yield p
 
 
+	def git_files(self, dirpath):
+		"""
+		Lists the files of a folder known to git, or returns None when git
+		can't be used there, so the folder is walked instead.
+		"""
+		if self.git == 'changed':
+			cmd = ['git', 'diff', '--name-only', '--relative', '--diff-filter=ACMR', '-z', self.git_since, '--']
+		else:
+			cmd = ['git', 'ls-files', '-z', '--cached']
+			if self.git == 'untracked':
+				cmd += ['--others', '--exclude-standard']
+
+		startupinfo = None
+		if os.name == 'nt':
+			startupinfo = subprocess.STARTUPINFO()
+			startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+		try:
+			proc = subprocess.Popen(cmd, cwd=dirpath, stdout=subprocess.PIPE,
+				stderr=subprocess.PIPE, startupinfo=startupinfo)
+			output = proc.communicate()[0]
+		except OSError:
+			return None
+
+		if proc.returncode != 0:
+			return None
+
+		# decode names the way os.walk does, so any path round-trips
+		try:
+			if sys.version_info < (3,0,0):
+				names = output
+			else:
+				names = output.decode(sys.getfilesystemencoding(), 'surrogateescape')
+		except(UnicodeDecodeError, LookupError):
+			return None
+
+		return [os.path.join(dirpath, f) for f in names.split('\0') if f]
+
+
+	def excluded(self, regex, path):
+		return regex is not None and regex.search(path) is not None
+
+
+	def ascii_compatible(self, encoding):
+		try:
+			return 'TODO: @\n'.encode(encoding) == b'TODO: @\n'
+		except LookupError:
+			return False
+
+
+	def compile_prefix(self, patterns, case, encoding):
+		"""
+		Builds a bytes regex of the literal text every pattern starts with,
+		or returns None when some pattern has no such literal prefix.
+		"""
+		prefixes = []
+		for patt in patterns:
+			if '|' in patt:
+				return None
+
+			prefix = ''
+			for c in patt:
+				if c in '.^$*+?{}[]\\|()':
+					if c in '*?{' and prefix:
+						prefix = prefix[:-1]
+					break
+				prefix += c
+
+			if not prefix or (case and any(ord(c) > 127 for c in prefix)):
+				return None
+			prefixes.append(re.escape(prefix.encode(encoding)))
+
+		if not prefixes:
+			return None
+		return re.compile(b'|'.join(prefixes), case)
+
+
+	def candidate(self, p):
+		"""
+		Tells if a file can contain any match without decoding it: skips
+		binary extensions, files larger than max_file_size, files with NUL
+		bytes in the first block, and files without any pattern prefix.
+		"""
+		if os.path.splitext(p)[1].lower() in self.binary_exts:
+			return False
+
+		try:
+			size = os.path.getsize(p)
+			if size == 0 or (self.max_size and size > self.max_size):
+				return False
+			if not self.sniff:
+				return True
+
+			with io.open(p, 'rb') as f:
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				try:
+					if b'\0' in data[:8192]:
+						return False
+					return self.prefix is None or self.prefix.search(data) is not None
+				finally:
+					data.close()
+		except(IOError, OSError, ValueError):
+			return True
+
+
 	def extract(self, files):
 		encoding = settings.get('encoding', 'utf-8')
 		for p in files:
+			f = None
+			items = []
 			try:
 				if p in self.open_files:
 					for view in self.open:
@@ -102,41 +329,104 @@ class Engine():
 								f.append(view.substr(line))
 							break
 				else:
-					f = io.open(p, 'r', encoding=encoding)
+					cached = self.index.get(p) if self.index else None
+					if cached is not None:
+						items = cached
+					elif not self.candidate(p):
+						if self.index:
+							self.index.put(p, items)
+					else:
+						f = io.open(p, 'r', encoding=encoding)
+
+				if f is not None:
+					for num, line in enumerate(f, 1):
+						for result in self.patterns.finditer(line):
+							for patt, note in result.groupdict().items():
+
+								if not note and note != '':
+									continue
+
+								priority_match = self.priority.search(note)
+
+								if(priority_match):
+									priority = int(priority_match.group(1))
+								else:
+									priority = 100
+
+								items.append({
+									'file': p,
+									'patt': patt,
+									'note': note,
+									'line': num,
+									'priority': priority
+								})
+
+					if self.index and type(f) is not list:
+						self.index.put(p, items)
+
+			except(IOError, UnicodeDecodeError):
+				pass
 
-				for num, line in enumerate(f, 1):
-					for result in self.patterns.finditer(line):
-						for patt, note in result.groupdict().items():
+			finally:
+				thread.increment()
+				if f is not None and type(f) is not list:
+					f.close()
 
-							if not note and note != '':
-								continue
+			for item in items:
+				yield item
 
-							priority_match = self.priority.search(note)
 
-							if(priority_match):
-								priority = int(priority_match.group(1))
-							else:
-								priority = 100
+	def process(self, workers=1):
+		if workers < 2 or sys.version_info < (3,0,0):
+			return self.extract(self.files())
+		return self.extract_parallel(self.files(), workers)
 
-							yield {
-								'file': p,
-								'patt': patt,
-								'note': note,
-								'line': num,
-								'priority': priority
-							}
 
-			except(IOError, UnicodeDecodeError):
-				f = None
+	def extract_parallel(self, files, workers):
+		todo = queue.Queue(workers * 8)
+		done = queue.Queue()
+		errors = []
 
+		def feed():
+			# the workers must always be told to stop, or the scan never ends
+			try:
+				for p in files:
+					todo.put(p)
+			except Exception as e:
+				errors.append(e)
 			finally:
-				thread.increment()
-				if f is not None and type(f) is not list:
-					f.close()
+				for _ in range(workers):
+					todo.put(None)
 
+		def work():
+			try:
+				for p in iter(todo.get, None):
+					done.put(list(self.extract([p])))
+			except Exception as e:
+				errors.append(e)
+				# keep taking files so the feeder isn't blocked
+				for p in iter(todo.get, None):
+					pass
+			finally:
+				done.put(None)
+
+		for target in [feed] + [work] * workers:
+			t = threading.Thread(target=target)
+			t.daemon = True
+			t.start()
+
+		finished = 0
+		while finished < workers:
+			results = done.get()
+			if results is None:
+				finished += 1
+				continue
+			for result in results:
+				yield result
 
-	def process(self):
-		return self.extract(self.files())
+		# report errors of the helper threads in the scanning thread
+		if errors:
+			raise errors[0]
 
 
 	def resolve(self, directory):
@@ -164,8 +454,32 @@ class Thread(threading.Thread):
 
 
 	def thread(self):
-		results = list(self.engine.process())
-		self.callback(results, self.finish(), self.i)
+		results = []
+		interval = settings.get('render_interval', 0.5)
+
+		if self.engine.index:
+			self.engine.index.load()
+		last = timeit.default_timer()
+
+		failed = False
+		try:
+			for result in self.engine.process(settings.get('scan_threads', 4)):
+				results.append(result)
+				if interval and timeit.default_timer() - last >= interval:
+					last = timeit.default_timer()
+					self.callback(list(results), self.finish(), self.i, False)
+		except Exception as e:
+			failed = True
+			traceback.print_exc()
+			sublime.status_message("TodoReview: scan failed: {0}".format(e))
+
+		if self.engine.index:
+			# an interrupted walk didn't visit everything, so keep the rest
+			if not failed:
+				self.engine.index.prune(self.engine.walked_roots(), self.engine.seen_paths)
+			self.engine.index.save()
+
+		self.callback(results, self.finish(), self.i, True)
 
 
 	def finish(self):
@@ -205,35 +519,43 @@ class TodoReviewCommand(sublime_plugin.TextCommand):
 		else:
 			paths = []
 
-		engine = Engine(paths, filepaths, self.view)
+		git = args.get('git', settings.get('git', False))
+		git_since = args.get('git_since', settings.get('git_since', 'HEAD'))
+
+		self.window_id = window.id()
+		engine = Engine(paths, filepaths, self.view, git, git_since)
 		thread = Thread(engine, self.render)
 		thread.start()
 
 
-	def render(self, results, time, count):
+	def render(self, results, time, count, final=True):
 		self.view.run_command('todo_review_render', {
 			"results": results,
 			"time": time,
 			"count": count,
-			"args": self.args
+			"args": self.args,
+			"window": self.window_id,
+			"final": final
 		})
 
 
 class TodoReviewRender(sublime_plugin.TextCommand):
 
-	def run(self, edit, results, time, count, args):
+	def run(self, edit, results, time, count, args, window=None, final=True):
 		self.args = args
 		self.edit = edit
 		self.time = time
 		self.count = count
 		self.results = results
 		self.sorted = self.sort()
-		self.rview = self.get_view()
+		self.rview = self.get_view(window)
 
 		self.draw_header()
 		self.draw_results()
 
-		self.window.focus_view(self.rview)
+		# partial results are drawn in place; only the final render takes focus
+		if final:
+			self.window.focus_view(self.rview)
 		self.args['settings'] = settings.proj
 		self.rview.settings().set('review_args', self.args)
 
@@ -253,8 +575,16 @@ class TodoReviewRender(sublime_plugin.TextCommand):
 		return itertools.groupby(results, key=lambda m: m['patt'])
 
 
-	def get_view(self):
+	def get_view(self, window=None):
+		"""
+		Results go to the window the scan was started from, even if
+		another window has been focused since
+		"""
 		self.window = sublime.active_window()
+		for w in sublime.windows():
+			if w.id() == window:
+				self.window = w
+				break
 
 		for view in self.window.views():
 			if view.settings().get('todo_results', False):